@@ -5,28 +5,38 @@ Copyright © 2023 Syd Polk
 """
 
 import datetime
+import heapq
 import os
 import queue
-import re
 import sys
+import threading
 import time
 
 from pathlib import Path
 
+import candidateFilter
+import destinationIndex
+import encodeController
+import encodeEstimator
+import encodeProfiles
+import encodeProgress
+import encodeScheduler
+import fileIndex
 import h265Converter
+import libraryWatcher
+import metricsExporter
+import probeCache
+import queuePolicies
+import stagingPrefetcher
 
 midnight_lower = datetime.datetime.strptime("00:00:00", '%H:%M:%S').time()
-midnight_upper = datetime.datetime.strptime("23:59:59", '%H:%M:%S').time()
 
 
 class TreeTraverser:
 
     video_suffixes = ['.mp4', '.mkv', '.webm', '.avi', '.ts', '.m4v',
                     '.MP4', '.mpg', '.mov', '.MOV', '.3gp', '.h265', '.srt']
-    ignored_suffixes = ['.h265.mp4']
-    directories_to_skip = ['tmp', '.grab', 'Photos Library.photoslibrary', 'Archive', 'Ripped', 'Music', 'Recordings - raw', 'Logs', 'Vault', 'Staging']
-    file_pattern_to_skip = '.*\\(copy.*\\)'
-    file_pattern_to_skip_re = re.compile(file_pattern_to_skip)
+    candidate_filter = None
 
     suffix = ''
     overwrite = False
@@ -45,11 +55,50 @@ class TreeTraverser:
     error_list = set()
     error_list_file = None
     refresh = 0
+    probe_cache = None
+    jobs = 1
+    lock = None
+    count = 0
+    space = 0
+    stop_requested = False
+    exit_code = 0
+    stop_file = Path("/tmp/stop")
+    scheduler = None
+    file_index = None
+    destination_index = None
+    watching = False
+    pending = None
+    reconcile_interval = 86400
+    poll_interval = 300
+    policy = None
+    estimator = None
+    estimates = {}
+    started_at = None
+    # Predicted encode times are padded by this factor before checking them against the window.
+    admission_margin = 1.1
+    resuming = set()
+    prefetcher = None
 
     def __init__(self, suffix='.v2.mp4', overwrite=False, force=False, dry_run=False, tmp_dir=None,
                  flat_dest = False, preserve_source=False, start_time=None, stop_time=None,
-                 stop_when_complete=False,refresh=0,error_list_file=None, skip_newer=True):
+                 stop_when_complete=False,refresh=0,error_list_file=None, skip_newer=True,
+                 probe_cache_file=None, jobs=1, schedule_cpus=False, cpu_affinity=False, index_file=None,
+                 reconcile_interval=86400, poll_interval=300, segments=1,
+                 segment_min_size=20 * 1024 * 1024 * 1024, segment_min_duration=2 * 60 * 60,
+                 queue_policy='smallest', throughput_history_file=None, window_action='finish',
+                 checkpoint_segment=600, resumable=False, status_file=None, progress_interval=60,
+                 min_savings=None, copy_max_bit_rate=None, profile_file=None, target_vmaf=None,
+                 target_size=None, crf_candidates=None, move_workers=2, stage_dir=None,
+                 stage_budget=100 * 1024 * 1024 * 1024, stage_ahead=2, scan_workers=8, filter_file=None,
+                 salvage_mode='stream'):
         self.suffix = suffix
+        self.candidate_filter = candidateFilter.CandidateFilter(suffix, self.video_suffixes, filter_file)
+        self.jobs = jobs
+        if schedule_cpus:
+            self.scheduler = encodeScheduler.EncodeScheduler(cpu_affinity)
+            if jobs <= 1:
+                self.jobs = self.scheduler.max_jobs()
+        self.lock = threading.RLock()
         self.flat_dest = flat_dest
         self.overwrite = overwrite
         self.force = force
@@ -68,85 +117,193 @@ class TreeTraverser:
         if tmp_dir:
             self.tmp_dir = Path(tmp_dir)
             self.tmp_dir.mkdir(parents=True, exist_ok=True)
-        self.converter = h265Converter.H265Converter(suffix, overwrite, force, dry_run, tmp_dir, preserve_source, self.video_suffixes)
+        self.probe_cache = probeCache.ProbeCache(probe_cache_file)
+        self.file_index = fileIndex.FileIndex(index_file, scan_workers)
+        self.destination_index = destinationIndex.DestinationIndex()
+        self.policy = queuePolicies.create_policy(queue_policy)
+        self.estimator = encodeEstimator.EncodeEstimator(throughput_history_file)
+        self.estimates = {}
+        self.reconcile_interval = reconcile_interval
+        self.poll_interval = poll_interval
+        controller = None
+        if window_action != 'finish' or resumable:
+            should_stop = None
+            if resumable:
+                should_stop = lambda: self.stop_requested or self.stop_file.exists()
+            controller = encodeController.EncodeController(lambda: self.in_window(datetime.datetime.now().time()),
+                                                           window_action, should_stop=should_stop)
+        self.converter = h265Converter.H265Converter(suffix, overwrite, force, dry_run, tmp_dir, preserve_source,
+                                                     self.video_suffixes, self.probe_cache, segments,
+                                                     segment_min_size, segment_min_duration, controller,
+                                                     checkpoint_segment, resumable, status_file,
+                                                     progress_interval, min_savings, copy_max_bit_rate,
+                                                     profile_file, target_vmaf, target_size, crf_candidates,
+                                                     move_workers, salvage_mode)
+        self.converter.progress.library_status = self.library_status
+        self.converter.destination_index = self.destination_index
+        self.converter.profiles.window_remaining = self.window_remaining
+        self.converter.profiles.estimate_seconds = lambda media_info: self.estimator.encode_seconds(
+            media_info, media_info.size or 0)
+        metricsExporter.queue_files.set_function(lambda: self.library_status()[0])
+        metricsExporter.queue_bytes.set_function(lambda: self.library_status()[1])
+        self.resuming = set()
+        if stage_dir is not None:
+            self.prefetcher = stagingPrefetcher.StagingPrefetcher(self, stage_dir, stage_budget, stage_ahead)
         if start_time is not None:
             self.start_time = datetime.datetime.strptime(start_time, '%H:%M:%S').time()
         if stop_time is not None:
             self.stop_time = datetime.datetime.strptime(stop_time, '%H:%M:%S').time()
 
     def write_error(self, path):
-        if path not in self.error_list:
-            self.error_list.add(path)
-            if self.error_list_file is not None:
-                error_file = self.error_list_file.open('a')
-                error_file.write(f'{path}\n')
-                error_file.close()
+        with self.lock:
+            if path not in self.error_list:
+                self.error_list.add(path)
+                if self.error_list_file is not None:
+                    error_file = self.error_list_file.open('a')
+                    error_file.write(f'{path}\n')
+                    error_file.close()
 
     def read_errors(self):
         if self.error_list_file is not None and self.error_list_file.exists():
             error_file = self.error_list_file.open('r')
             files = error_file.readlines()
             error_file.close()
-            for file in files:
-                self.error_list.add(file.strip())
-
-    def should_convert(self, path):
-        # Skip extensions that are explicitly marked as non-convertible.
-        if str(path).lower().endswith(tuple(self.ignored_suffixes)):
-            return False
-        path_suffix = path.suffix.lower()
-        if not (path_suffix in self.video_suffixes):
-            return False
-        if self.file_pattern_to_skip_re.match(str(path)):
-            return False
-        suffixes = ""
-        for partial_suffix in reversed(path.suffixes):
-            suffixes = partial_suffix + suffixes
-            if suffixes == self.suffix:
-                return False
-        return True
+            with self.lock:
+                for file in files:
+                    self.error_list.add(file.strip())
 
-    def wait_for_window(self):
+    def in_window(self, now):
+        """
+        :param now: A datetime.time
+        :return: True if jobs may be started at now.
+        """
         if self.start_time is None and self.stop_time is None:
             return True
+        if self.stop_time is None:
+            return now >= self.start_time
+        if self.start_time is None:
+            return now < self.stop_time
+        if self.start_time < self.stop_time:
+            return self.start_time <= now < self.stop_time
+        return now >= self.start_time or now < self.stop_time
 
-        while True:
+    def window_remaining(self, now=None):
+        """
+        :return: Seconds left in the current encoding window, or None if it doesn't end.
+        """
+        if self.start_time is None and self.stop_time is None:
+            return None
+        if now is None:
             now = datetime.datetime.now()
-            # Check if current time is later than start_time
-            if self.start_time is not None and self.stop_time is None:
-                if now > self.start_time:
-                    return True
-
-            # Check if current time is earlier than stop_time
-            elif self.start_time is None and self.stop_time is not None:
-                if now < self.stop_time:
-                    return True
-
-            # Check to see if current_time is between start_time and stop_time
-            elif self.start_time < self.stop_time and self.start_time < now < self.stop_time:
-                return True
-
-            elif self.stop_time < self.start_time \
-                    and (self.start_time < now < midnight_lower
-                         or midnight_upper < now < self.stop_time):
-                return True
-
-            new_hour = now.hour
-            new_minute = now.minute + 10
-            if new_minute >= 60:
-                new_minute -= 60
-                new_hour += 1
-                if new_hour == 24:
-                    new_hour = 0
-            new_time = datetime.time(new_hour, new_minute, now.second)
-            print("[" + str(now) + "] Waiting; will check again at " + str(new_time))
-            if self.file_queue.qsize() == 0:
-                print('Queue currently empty.')
-            else:
-                space, name, _ = self.file_queue.queue[0]
-                print(f'Next entry: {name} ({self.size_string(space)})')
-            time.sleep(600)
-            return False
+        if not self.in_window(now.time()):
+            return 0
+        if self.stop_time is None:
+            end = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), midnight_lower)
+        else:
+            end = datetime.datetime.combine(now.date(), self.stop_time)
+            if end <= now:
+                end += datetime.timedelta(days=1)
+        return (end - now).total_seconds()
+
+    def wait_for_window(self):
+        if self.in_window(datetime.datetime.now().time()):
+            return True
+
+        now = datetime.datetime.now()
+        new_time = (now + datetime.timedelta(minutes=10)).time()
+        self.converter.log("[" + str(now) + "] Waiting; will check again at " + str(new_time))
+        if self.file_queue.qsize() == 0:
+            self.converter.log('Queue currently empty.')
+        else:
+            _, space, name, _, _ = self.file_queue.queue[0]
+            self.converter.log(f'Next entry: {name} ({self.size_string(space)})')
+        start = time.monotonic()
+        time.sleep(600)
+        metricsExporter.window_wait_seconds.inc(time.monotonic() - start)
+        return False
+
+    def window_length(self):
+        """
+        :return: The length of the encoding window in seconds, or None if it doesn't end.
+        """
+        if self.start_time is None and self.stop_time is None:
+            return None
+        start = datetime.datetime.combine(datetime.date.today(), self.start_time or midnight_lower)
+        if self.stop_time is None:
+            end = datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1), midnight_lower)
+        else:
+            end = datetime.datetime.combine(datetime.date.today(), self.stop_time)
+        if end <= start:
+            end += datetime.timedelta(days=1)
+        return (end - start).total_seconds()
+
+    def next_admissible(self):
+        """
+        Take the highest priority queued file whose predicted encode time fits in what is left of the
+        window. Smaller jobs backfill the end of the window. A job longer than the whole window is only
+        started in the first ten minutes of one, since it will never fit.
+        :return: A queue entry, or None if nothing is queued or nothing fits.
+        """
+        remaining = self.window_remaining()
+        if remaining is None and len(self.resuming) == 0:
+            try:
+                return self.file_queue.get_nowait()
+            except queue.Empty:
+                return None
+
+        window_length = self.window_length()
+        with self.file_queue.mutex:
+            entries = sorted(self.file_queue.queue)
+            if len(self.resuming) > 0:
+                # Interrupted encodes found at startup go first.
+                entries.sort(key=lambda entry: os.path.realpath(entry[2]) not in self.resuming)
+            chosen = None
+            for entry in entries:
+                encode_seconds = self.estimates[entry[2]].encode_seconds * self.admission_margin
+                if remaining is None or encode_seconds <= remaining:
+                    chosen = entry
+                    break
+            if chosen is None and len(entries) > 0:
+                encode_seconds = self.estimates[entries[0][2]].encode_seconds * self.admission_margin
+                if encode_seconds > window_length and remaining >= window_length - 600:
+                    chosen = entries[0]
+            if chosen is None:
+                return None
+            self.file_queue.queue.remove(chosen)
+            heapq.heapify(self.file_queue.queue)
+            self.resuming.discard(os.path.realpath(chosen[2]))
+            return chosen
+
+    def estimate(self, video, size):
+        """
+        :return: The Estimate for a queued file, probing it if the queue policy or the encoding window
+                 needs probe data.
+        """
+        if video in self.estimates:
+            return self.estimates[video]
+        media_info = None
+        if self.policy.needs_probe or self.start_time is not None or self.stop_time is not None:
+            media_info = self.probe_cache.probe(video)
+        if self.converter.can_copy_video(media_info):
+            estimate = self.estimator.copy_estimate(size)
+        else:
+            estimate = self.estimator.estimate(media_info, size)
+        with self.lock:
+            self.estimates[video] = estimate
+        return estimate
+
+    def reorder_queue(self):
+        """
+        Recompute every queued file's priority for the time left in the window.
+        """
+        remaining = self.window_remaining()
+        with self.file_queue.mutex:
+            entries = []
+            for _, size, video, dest_video, mtime in self.file_queue.queue:
+                priority = self.policy.priority(size, mtime, self.estimates[video], remaining)
+                entries.append((priority, size, video, dest_video, mtime))
+            heapq.heapify(entries)
+            self.file_queue.queue[:] = entries
 
     def size_string(self, size):
         if size > 1024 * 1024 * 1024 * 1024:
@@ -166,83 +323,257 @@ class TreeTraverser:
             unit = 'bytes'
         return f'{num:.3f} {unit}'
 
+    def process_queue(self):
+        """
+        Drain file_queue with self.jobs workers. A single job runs on the calling thread.
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.start()
+        try:
+            if self.jobs <= 1:
+                self.run_worker(None)
+            else:
+                workers = []
+                for job in range(1, self.jobs + 1):
+                    worker = threading.Thread(target=self.run_worker, args=(f'job {job}',), daemon=True)
+                    workers.append(worker)
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.stop()
+        self.converter.mover.wait()
+
+    def run_worker(self, label):
+        self.converter.set_job_label(label)
+        try:
+            while not self.stop_requested:
+                if self.stop_file.exists():
+                    self.converter.eprint(f'{datetime.datetime.now()}: Stop file {self.stop_file} exists. Remove it and restart to continue.')
+                    self.request_stop(1)
+                    break
+                if self.watching and self.file_queue.empty():
+                    time.sleep(5)
+                    continue
+                with self.lock:
+                    size_tag = self.size_string(self.space)
+                    self.converter.log(f'{datetime.datetime.now()}: {self.count} files; {size_tag}')
+                print("")
+                if not self.wait_for_window():
+                    if self.watching:
+                        continue
+                    break
+                if self.policy.dynamic:
+                    self.reorder_queue()
+                entry = self.next_admissible()
+                if entry is None:
+                    if self.file_queue.empty():
+                        if self.watching:
+                            continue
+                        break
+                    remaining = self.window_remaining()
+                    if remaining is None:
+                        # No window to fit in; something was queued after the queue was looked at.
+                        continue
+                    if not self.watching:
+                        self.converter.log(f'{datetime.datetime.now()}: Nothing queued fits in the {remaining / 60:.0f} '
+                                           f'minutes left in the window; leaving it for the next pass.')
+                        break
+                    self.converter.log(f'{datetime.datetime.now()}: Nothing queued fits in the {remaining / 60:.0f} '
+                                       f'minutes left in the window; waiting for the next one.')
+                    time.sleep(min(remaining + 1, 600))
+                    continue
+                self.convert_entry(entry)
+        except SystemExit as e:
+            # error_stop() exits; on a worker thread that only ends the thread, so stop the others too.
+            if threading.current_thread() is threading.main_thread():
+                raise
+            self.request_stop(e.code)
+        finally:
+            self.converter.set_job_label(None)
+
+    def request_stop(self, exit_code):
+        with self.lock:
+            self.stop_requested = True
+            self.exit_code = exit_code
+
+    def convert_entry(self, entry):
+        _, size, video, dest_video, mtime = entry
+
+        # See if the size of the file has changed since we looked at it last.
+        path = Path(video)
+        time_24_hours_ago = datetime.datetime.now() - datetime.timedelta(hours = 24)
+        interrupted = False
+        try:
+            try:
+                current_stat = path.stat()
+            except FileNotFoundError:
+                self.converter.log(f'{video} ({self.size_string(size)}) has disappeared.')
+                self.file_index.invalidate(video)
+            else:
+                time_of_file = datetime.datetime.fromtimestamp(current_stat.st_mtime)
+                if current_stat.st_size != size or current_stat.st_mtime != mtime:
+                    # Changed in place, which the index can't see from the directory mtime.
+                    self.file_index.invalidate(video)
+                if current_stat.st_size > size:
+                    self.converter.log(f'{video} has changed size since queue ({self.size_string(current_stat.st_size)} vs {self.size_string(size)}). Removing and letting the refresh put it back.')
+                elif self.skip_newer and time_of_file > time_24_hours_ago:
+                    self.converter.log(f'{video} ({self.size_string(size)}) is too new ({datetime.datetime.strftime(time_of_file, "%Y-%m-%d %H:%M:%S")}). Removing and letting the refresh put it back.')
+                else:
+                    media_info = self.probe_cache.probe(video, current_stat)
+                    staged = None
+                    if self.prefetcher is not None:
+                        staged = self.prefetcher.take(video, current_stat.st_size, current_stat.st_mtime)
+                    try:
+                        converted = self.convert_with_slot(video, dest_video, media_info, staged)
+                    except encodeController.EncodeInterrupted:
+                        interrupted = True
+                    except encodeProgress.EncodeAbandoned:
+                        pass
+                    else:
+                        if not converted:
+                            self.write_error(video)
+                            metricsExporter.failed.inc()
+                            print("")
+                        elif not self.dry_run:
+                            encode_seconds = self.converter.job_encode_seconds()
+                            if encode_seconds is not None and not self.converter.can_copy_video(media_info):
+                                self.estimator.record(media_info, self.medium_seconds(encode_seconds))
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.release(video)
+            with self.lock:
+                self.file_set.discard(video)
+                self.estimates.pop(video, None)
+                self.count -= 1
+                self.space -= size
+        if interrupted:
+            # Checkpointed at the window edge; queue it again so it picks up where it stopped.
+            self.enqueue_file(video, size, mtime, Path(dest_video).parent)
+        print("")
+
+    def medium_seconds(self, seconds):
+        """
+        Scale the time an encode took to what it would have taken at the medium preset, which is
+        what the estimator predicts.
+        """
+        profile = self.converter.job_profile()
+        if profile is None or profile.preset is None:
+            return seconds
+        return seconds * encodeProfiles.preset_speeds[profile.preset]
+
+    def library_status(self):
+        """
+        :return: (files, bytes) queued or being converted.
+        """
+        with self.lock:
+            return self.count, self.space
+
+    def convert_with_slot(self, video, dest_video, media_info, staged=None):
+        """
+        Convert one file, holding a CPU budget from the scheduler for the duration when there is one.
+        """
+        if self.scheduler is None:
+            return self.converter.convert_video(video, dest_video, staged=staged)
+
+        slot = self.scheduler.acquire(media_info)
+        self.converter.log(f'{datetime.datetime.now()}: Scheduled with {slot.threads} threads.')
+        try:
+            return self.converter.convert_video(video, dest_video, slot, staged)
+        finally:
+            self.scheduler.release(slot)
+
+    def destination_for(self, top, root, dest_path):
+        if self.flat_dest:
+            return dest_path
+        subdir = Path(top).relative_to(root)
+        return dest_path.joinpath(subdir)
+
+    def enqueue_file(self, video, size, mtime, final_dest):
+        """
+        Queue one candidate, or remove it if it has already been converted.
+        In watch mode, files still inside the skip_newer quiet period are held back until it ends.
+        """
+        if video in self.error_list or video in self.file_set or self.converter.mover.is_pending(video):
+            return
+        if self.probe_cache.is_unprofitable(video, size, mtime):
+            return
+        # Every filter runs before the source can be removed below.
+        if not self.candidate_filter.want(video):
+            return
+        if not self.candidate_filter.accept(video, size, mtime, lambda: self.probe_cache.probe(video)):
+            return
+        new_path_with_name = self.converter.new_video_name(Path(video), final_dest)
+        # The index can be out of date, so only the target itself can justify removing the source.
+        if self.destination_index.exists(new_path_with_name) and new_path_with_name.exists():
+            if not self.preserve_source:
+                print(f'Removing {video}; target {new_path_with_name} exists.')
+                Path(video).unlink()
+            return
+        if self.pending is not None and self.skip_newer:
+            ready_time = datetime.datetime.fromtimestamp(mtime) + datetime.timedelta(hours=24)
+            if ready_time > datetime.datetime.now():
+                if video not in self.pending:
+                    print(f'{video} ({self.size_string(size)}) is too new; holding it until {ready_time}.')
+                self.pending[video] = (ready_time, final_dest)
+                return
+            self.pending.pop(video, None)
+        print(f'{video} ({self.size_string(size)}) -> {final_dest}')
+        with self.lock:
+            self.file_set.add(video)
+            self.count += 1
+            self.space += size
+        estimate = self.estimate(video, size)
+        priority = self.policy.priority(size, mtime, estimate, self.window_remaining())
+        self.file_queue.put((priority, size, video, str(new_path_with_name), mtime))
+
+    def find_interrupted(self):
+        """
+        Note encodes that were interrupted by a crash or the stop file, so they are converted first
+        when the scan finds them. Only encodes whose work is in tmp_dir can be found.
+        """
+        for journal in self.converter.segmented_encoder.find_journals(self.tmp_dir):
+            completed = len(journal['completed'])
+            print(f'{datetime.datetime.now()}: Found interrupted encode of {journal["source"]} '
+                  f'({completed} of {len(journal["plan"])} segments done).')
+            self.resuming.add(journal['source'])
+
+    def scan_tree(self, root, dest_path):
+        self.read_errors()
+        self.destination_index.new_pass()
+        start = time.monotonic()
+        seen_files = set()
+        for top, file, size, mtime in self.file_index.scan(root, self.candidate_filter.skip_directories,
+                                                           self.candidate_filter.want):
+            video = os.path.join(top, file)
+            seen_files.add(video)
+            self.enqueue_file(video, size, mtime, self.destination_for(top, root, dest_path))
+        metricsExporter.scan_seconds.observe(time.monotonic() - start)
+        print(f'{datetime.datetime.now()}: Scanned {root}: listed {self.file_index.directories_listed} changed '
+              f'directories, reused {self.file_index.directories_reused}, stat\'ed {self.file_index.files_statted} files; '
+              f'listed {self.destination_index.directories_listed} destination directories.')
+
+        evicted = self.probe_cache.prune(root, seen_files)
+        if evicted > 0:
+            print(f'{datetime.datetime.now()}: Evicted {evicted} stale probe cache entries.')
+
     def traverse(self, source, dest=None):
-        self.start_time = datetime.datetime.now()
+        self.started_at = datetime.datetime.now()
         root = Path(source)
-        count = 0
-        space = 0
         if dest:
             dest_path = Path(dest)
         else:
             dest_path = root
+        self.find_interrupted()
         rechecking = True
-        stop_file = Path("/tmp/stop")
         while rechecking:
-            self.read_errors()
-            for top, dirs, files in os.walk(root):
-                pass
-                for skip in self.directories_to_skip:
-                    if skip in dirs:
-                        dirs.remove(skip)
-                for file in files:
-                    video = os.path.join(top, file)
-                    path = Path(video)
-                    if video in self.error_list:
-                        continue
-                    if not self.should_convert(path):
-                        continue
-                    if self.flat_dest:
-                        final_dest = dest_path
-                    else:
-                        subdir = Path(top).relative_to(root)
-                        final_dest = dest_path.joinpath(subdir)
-                    new_path_with_name = self.converter.new_video_name(Path(video), final_dest)
-                    if video not in self.file_set and not new_path_with_name.exists():
-                        size = path.stat().st_size
-                        mtime = path.stat().st_mtime
-                        print(f'{video} ({self.size_string(size)}) -> {final_dest}')
-                        self.file_set.add(video)
-                        self.file_queue.put((size, video, str(new_path_with_name), mtime))
-                        count += 1
-                        space += size
-                    else:
-                        if not self.preserve_source:
-                            print(f'Removing {video}; target {new_path_with_name} exists.')
-                            Path(video).unlink()
+            self.scan_tree(root, dest_path)
 
             print("")
-            while not self.file_queue.empty():
-                if stop_file.exists():
-                    print(f'{datetime.datetime.now()}: Stop file {stop_file} exists. Remove it and restart to continue.', file=sys.stderr)
-                    exit(1)
-                size_tag = self.size_string(space)
-                print(f'{datetime.datetime.now()}: {count} files; {size_tag}')
-                print("")
-                if not self.wait_for_window():
-                    break
-                size, video, dest_video, mtime = self.file_queue.get()
-
-                # See if the size of the file has changed since we looked at it last.
-                path = Path(video)
-                time_24_hours_ago = datetime.datetime.now() - datetime.timedelta(hours = 24)
-                try:
-                    current_stat = path.stat()
-                except FileNotFoundError:
-                    print(f'{video} ({self.size_string(size)}) has disappeared.')
-                else:
-                    time_of_file = datetime.datetime.fromtimestamp(current_stat.st_mtime)
-                    if current_stat.st_size > size:
-                        print(f'{video} has changed size since queue ({self.size_string(current_stat.st_size)} vs {self.size_string(size)}). Removing and letting the refresh put it back.')
-                    elif self.skip_newer and time_of_file > time_24_hours_ago:
-                        print(f'{video} ({self.size_string(size)}) is too new ({datetime.datetime.strftime(time_of_file, "%Y-%m-%d %H:%M:%S")}). Removing and letting the refresh put it back.')
-                    elif not self.converter.convert_video(video, dest_video):
-                        self.write_error(video)
-                        print("")
-
-                self.file_set.remove(video)
-                count -= 1
-                space -= size
-                print("")
+            self.process_queue()
+            if self.stop_requested:
+                exit(self.exit_code)
 
             if self.refresh > 0:
                 current_time = datetime.datetime.now()
@@ -251,9 +582,84 @@ class TreeTraverser:
                 time.sleep(self.refresh)
 
                 print('Rechecking files...')
-                self.start_time = datetime.datetime.now()
+                self.started_at = datetime.datetime.now()
 
             rechecking = not self.stop_when_complete
 
         print(f"{datetime.datetime.now()}: Done.")
 
+    def watch(self, source, dest=None):
+        """
+        Event-driven alternative to traverse(). After one full scan, files are queued as they are
+        written or moved into the tree, and conversions run continuously. The tree is only rescanned
+        every reconcile_interval seconds, or when the watcher loses events.
+        """
+        self.started_at = datetime.datetime.now()
+        root = Path(source)
+        if dest:
+            dest_path = Path(dest)
+        else:
+            dest_path = root
+        self.pending = {}
+        self.watching = True
+        want = self.candidate_filter.want
+        self.find_interrupted()
+        watcher = libraryWatcher.create_watcher(self.file_index, root, self.candidate_filter.skip_directories, want,
+                                                self.poll_interval)
+        self.scan_tree(root, dest_path)
+        next_reconcile = time.monotonic() + self.reconcile_interval
+        if self.prefetcher is not None:
+            self.prefetcher.start()
+
+        workers = []
+        for job in range(1, self.jobs + 1):
+            label = f'job {job}' if self.jobs > 1 else None
+            worker = threading.Thread(target=self.run_worker, args=(label,), daemon=True)
+            workers.append(worker)
+            worker.start()
+
+        try:
+            while not self.stop_requested:
+                for video in watcher.poll(10):
+                    if not want(video):
+                        continue
+                    # Written in place doesn't change the directory mtime the index relies on.
+                    self.file_index.invalidate(video)
+                    try:
+                        stat_result = os.stat(video)
+                    except OSError:
+                        continue
+                    top = os.path.dirname(video)
+                    final_dest = self.destination_for(top, root, dest_path)
+                    self.destination_index.refresh(final_dest)
+                    self.enqueue_file(video, stat_result.st_size, stat_result.st_mtime, final_dest)
+
+                now = datetime.datetime.now()
+                for video, (ready_time, final_dest) in list(self.pending.items()):
+                    if ready_time > now:
+                        continue
+                    try:
+                        stat_result = os.stat(video)
+                    except OSError:
+                        self.pending.pop(video, None)
+                        continue
+                    self.enqueue_file(video, stat_result.st_size, stat_result.st_mtime, final_dest)
+
+                if watcher.overflowed or time.monotonic() >= next_reconcile:
+                    print(f'{datetime.datetime.now()}: Reconciling {root}...')
+                    watcher.overflowed = False
+                    self.scan_tree(root, dest_path)
+                    next_reconcile = time.monotonic() + self.reconcile_interval
+
+                if self.stop_file.exists():
+                    print(f'{datetime.datetime.now()}: Stop file {self.stop_file} exists. Remove it and restart to continue.', file=sys.stderr)
+                    self.request_stop(1)
+        finally:
+            watcher.close()
+
+        for worker in workers:
+            worker.join()
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        self.converter.mover.wait()
+        exit(self.exit_code)
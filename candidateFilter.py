@@ -0,0 +1,154 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import fnmatch
+import json
+import os
+import re
+import time
+
+from pathlib import Path
+
+
+class SkippedDirectories(frozenset):
+    """
+    Directory names not to descend into: the configured ones, and every hidden directory. That
+    includes the work directories that segmented encodes and CRF searches keep next to their output
+    when there is no tmp_dir, whose files must never be taken for sources.
+    """
+
+    def __contains__(self, name):
+        return name.startswith('.') or frozenset.__contains__(self, name)
+
+
+class CandidateFilter:
+    """
+    Decides which files in the library are conversion candidates. The rules are compiled once:
+    suffixes become a set and a tuple for endswith, and every glob and regex becomes one combined
+    regex each for including and excluding, so classifying a path costs a set lookup and at most
+    two regex matches.
+
+    Rules can be loaded from a JSON file; any key it sets replaces the default:
+
+        {
+            "include_suffixes": [".mkv", ".ts"],      last suffix of the name, case-insensitive
+            "exclude_suffixes": [".h265.mp4"],        trailing suffixes, case-insensitive
+            "skip_directories": ["tmp", "Archive"],   directory names that are not descended into, besides
+                                                      hidden ones
+            "include_globs": ["/media/tv/*"],         if given, the full path must match one
+            "exclude_globs": ["*/Extras/*"],
+            "exclude_regexes": [".*\\\\(copy.*\\\\)"],  matched against the full path from its start
+            "min_size": 104857600,                    bytes
+            "max_size": null,
+            "min_age_days": 0,                        by mtime
+            "max_age_days": null,
+            "include_codecs": [],                     from the probe cache; if given, the video codec
+            "exclude_codecs": ["hevc", "av1"]         must be one of these, and not one of those
+        }
+
+    The output suffix of the conversion is always excluded. include_suffixes defaults to the
+    video suffixes the converter knows.
+    """
+
+    defaults = {
+        'include_suffixes': None,
+        'exclude_suffixes': ['.h265.mp4'],
+        'skip_directories': ['tmp', '.grab', 'Photos Library.photoslibrary', 'Archive', 'Ripped', 'Music',
+                             'Recordings - raw', 'Logs', 'Vault', 'Staging'],
+        'include_globs': [],
+        'exclude_globs': [],
+        'exclude_regexes': ['.*\\(copy.*\\)'],
+        'min_size': None,
+        'max_size': None,
+        'min_age_days': None,
+        'max_age_days': None,
+        'include_codecs': [],
+        'exclude_codecs': []
+    }
+
+    rules = {}
+    include_suffixes = frozenset()
+    exclude_suffixes = ()
+    skip_directories = SkippedDirectories()
+    include_re = None
+    exclude_re = None
+    include_codecs = frozenset()
+    exclude_codecs = frozenset()
+
+    def __init__(self, output_suffix, video_suffixes, rule_file=None):
+        self.rules = dict(self.defaults)
+        self.rules['include_suffixes'] = list(video_suffixes)
+        if rule_file is not None:
+            loaded = json.loads(Path(rule_file).expanduser().read_text())
+            unknown = set(loaded).difference(self.defaults)
+            if len(unknown) > 0:
+                raise ValueError(f'{rule_file}: unknown filter rules {sorted(unknown)}')
+            self.rules.update(loaded)
+        self.compile(output_suffix)
+
+    def compile(self, output_suffix):
+        rules = self.rules
+        self.include_suffixes = frozenset(suffix.lower() for suffix in rules['include_suffixes'])
+        self.exclude_suffixes = tuple({suffix.lower() for suffix in rules['exclude_suffixes'] + [output_suffix]})
+        self.skip_directories = SkippedDirectories(rules['skip_directories'])
+        self.include_re = self.combine([fnmatch.translate(glob) for glob in rules['include_globs']])
+        self.exclude_re = self.combine([fnmatch.translate(glob) for glob in rules['exclude_globs']] +
+                                       rules['exclude_regexes'])
+        self.include_codecs = frozenset(rules['include_codecs'])
+        self.exclude_codecs = frozenset(rules['exclude_codecs'])
+
+    def combine(self, patterns):
+        if len(patterns) == 0:
+            return None
+        return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+
+    @property
+    def needs_probe(self):
+        return len(self.include_codecs) > 0 or len(self.exclude_codecs) > 0
+
+    def want(self, path):
+        """
+        The checks that only need the path. Used during the scan to avoid stat'ing other files.
+        """
+        path = os.fspath(path)
+        name = os.path.basename(path).lower()
+        if name.startswith('.'):
+            # Partial and temporary outputs are hidden files.
+            return False
+        if os.path.splitext(name)[1] not in self.include_suffixes:
+            return False
+        if name.endswith(self.exclude_suffixes):
+            return False
+        if self.include_re is not None and not self.include_re.match(path):
+            return False
+        if self.exclude_re is not None and self.exclude_re.match(path):
+            return False
+        return True
+
+    def accept(self, path, size, mtime, probe=None):
+        """
+        The checks on size, age and codec, for a path that want() accepted.
+        :param probe: Callable returning the file's MediaInfo; only called if there are codec rules.
+        """
+        rules = self.rules
+        if rules['min_size'] is not None and size < rules['min_size']:
+            return False
+        if rules['max_size'] is not None and size > rules['max_size']:
+            return False
+        if rules['min_age_days'] is not None or rules['max_age_days'] is not None:
+            age_days = (time.time() - mtime) / 86400
+            if rules['min_age_days'] is not None and age_days < rules['min_age_days']:
+                return False
+            if rules['max_age_days'] is not None and age_days > rules['max_age_days']:
+                return False
+        if self.needs_probe and probe is not None:
+            media_info = probe()
+            codec = media_info.video_codec if media_info is not None else None
+            if len(self.include_codecs) > 0 and codec not in self.include_codecs:
+                return False
+            if codec in self.exclude_codecs:
+                return False
+        return True
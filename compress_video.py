@@ -8,6 +8,17 @@ Copyright © 2023 Syd Polk
 
 import h265Converter
 import argparse
+import probeCache
+import sys
+import TreeTraverser
+
+
+def check_at_least_one(value):
+    ivalue = int(value)
+    if ivalue < 1:
+        raise argparse.ArgumentTypeError("%s is an invalid positive int value" % value)
+    return ivalue
+
 
 parser = argparse.ArgumentParser(description="Convert video files to libx265 mp4 files using ffmpeg",
                                  prog="covert_video",
@@ -16,7 +27,7 @@ parser = argparse.ArgumentParser(description="Convert video files to libx265 mp4
 parser.add_argument('files', type=str, nargs='+',
                     help=
                     '''
-                    Files to convert. 
+                    Files to convert. Directories are searched recursively for video files.
                     ''')
 parser.add_argument('--continue', '-f', action='store_true', dest='force',
                     help=
@@ -43,14 +54,25 @@ parser.add_argument('--destination', '-o',
                     of 'non-existing' will be created and destination files will be written into it. All extensions of
                     the source files will be changed to '.mp4'.
 
-                    For now, any directory entries in the source list will be skipped.
-
-                    TBD: Create missing subdirectories
-                    TBD: Recursive traversal and creation of destination directories
+                    <source_directory> [<source>...] --destination <directory> - The video files under
+                    'source_directory' will be written under 'directory/source_directory', with missing
+                    subdirectories created to match the source tree.
 
                     Without the --destination setting, all files will be converted in the directories in which
                     they reside, subject to the --overwrite and --continue flags.
                     ''')
+parser.add_argument('--jobs', '-j', type=check_at_least_one, default=1,
+                    help=
+                    '''
+                    Number of files to convert at the same time. Each job runs its own ffmpeg, and its output is
+                    prefixed with its position in the batch.
+                    ''')
+parser.add_argument('--probe-cache',
+                    help=
+                    '''
+                    SQLite file used to cache ffprobe results between runs. Without this, results are only cached
+                    for the batch.
+                    ''')
 parser.add_argument('--dry-run', '-n', action='store_true',
                     help=
                     '''
@@ -82,7 +104,12 @@ parser.add_argument('--tmp-dir', '--tmp', '-t',
                     ''')
 args = parser.parse_args()
 
+probe_cache = None
+if args.probe_cache is not None:
+    probe_cache = probeCache.ProbeCache(args.probe_cache)
 converter = h265Converter.H265Converter(args.suffix, args.overwrite, args.force, args.dry_run,
-                                       args.tmp_dir, args.preserve_source)
-converter.convert_videos(args.files, args.destination)
+                                       args.tmp_dir, args.preserve_source, TreeTraverser.TreeTraverser.video_suffixes,
+                                       probe_cache)
+if not converter.convert_videos(args.files, args.destination, args.jobs):
+    sys.exit(1)
 
@@ -9,6 +9,8 @@ Copyright © 2023 Syd Polk
 
 import TreeTraverser
 import argparse
+import metricsExporter
+import queuePolicies
 
 
 def check_positive(value):
@@ -18,6 +20,13 @@ def check_positive(value):
     return ivalue
 
 
+def check_at_least_one(value):
+    ivalue = int(value)
+    if ivalue < 1:
+        raise argparse.ArgumentTypeError("%s is an invalid positive int value" % value)
+    return ivalue
+
+
 parser = argparse.ArgumentParser(description="Convert video files to libx265 mp4 files using ffmpeg",
                                  prog="compress_video_library",
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -81,7 +90,7 @@ parser.add_argument('--stop-when-complete', '-x', action='store_true',
                     help=
                     '''
                     Stop after one complete pass through the tree. This is not the default, as this is designed
-                    to be a file system watch dog.
+                    to be a file system watch dog. See also --watch.
                     ''')
 parser.add_argument('--suffix', '-s', nargs=1, default='.v2.mp4',
                     help=
@@ -113,9 +122,236 @@ parser.add_argument('--dont-skip-newer', action='store_false', dest='skip_newer'
                     If a file is less than 24 hours, skip it. This is so that if Plex is recording a file,
                     we don't try to encode an incomplete recording.
                     ''')
+parser.add_argument('--probe-cache',
+                    help=
+                    '''
+                    SQLite file used to cache ffprobe results between runs. Entries are invalidated when a file's
+                    size, mtime or inode changes. Without this, results are only cached for the life of the process.
+                    ''')
+parser.add_argument('--jobs', '-j', type=check_at_least_one, default=1,
+                    help=
+                    '''
+                    Number of files to convert at the same time. Each job runs its own ffmpeg, and its output is
+                    prefixed with the job number.
+                    ''')
+parser.add_argument('--schedule-cpus', action='store_true',
+                    help=
+                    '''
+                    Give each encode an explicit x265 thread budget sized from its resolution, and only start a
+                    job when enough cores are free for it. If --jobs isn't given, it is sized from the core count.
+                    ''')
+parser.add_argument('--cpu-affinity', action='store_true',
+                    help=
+                    '''
+                    With --schedule-cpus, also pin each encode to its own set of cores.
+                    ''')
+parser.add_argument('--scan-index',
+                    help=
+                    '''
+                    SQLite file holding an index of the source tree. Refreshes only list directories whose mtime
+                    has changed and only stat new files. Without this, the index only lives for the process, so
+                    the first scan of each run is a full one.
+                    ''')
+parser.add_argument('--watch', action='store_true',
+                    help=
+                    '''
+                    Watch the source tree for new files instead of rescanning it every --refresh seconds. Uses
+                    inotify on Linux and polls elsewhere. Files are queued as soon as they are finished, or once
+                    they are 24 hours old unless --dont-skip-newer is given.
+                    ''')
+parser.add_argument('--reconcile-interval', type=check_positive, default=86400,
+                    help=
+                    '''
+                    With --watch, seconds between full rescans that pick up anything the watcher missed.
+                    ''')
+parser.add_argument('--poll-interval', type=check_positive, default=300,
+                    help=
+                    '''
+                    With --watch, seconds between scans when inotify isn't available.
+                    ''')
+parser.add_argument('--segments', type=check_at_least_one, default=1,
+                    help=
+                    '''
+                    Split large sources into this many keyframe-aligned segments, encode them in parallel, and join
+                    them losslessly. Audio is encoded once for the whole file. 1 disables segmenting.
+                    ''')
+parser.add_argument('--segment-min-size', type=float, default=20,
+                    help=
+                    '''
+                    With --segments, only segment sources at least this many gigabytes in size...
+                    ''')
+parser.add_argument('--segment-min-duration', type=check_positive, default=7200,
+                    help=
+                    '''
+                    ...or at least this many seconds long.
+                    ''')
+parser.add_argument('--queue-policy', choices=sorted(queuePolicies.policies), default='smallest',
+                    help=
+                    '''
+                    Order in which queued files are converted. 'smallest' goes by file size. 'savings' puts the
+                    files expected to save the most space per hour of encoding first, estimated from codec,
+                    resolution and bit rate. 'oldest' goes by modification time. 'deadline' prefers files whose
+                    estimated encode fits in what is left of the --start-time/--stop-time window.
+                    ''')
+parser.add_argument('--throughput-history',
+                    help=
+                    '''
+                    JSON file where encode speed, learned from finished conversions, is kept between runs. With
+                    --stop-time, a job is only started if its predicted encode time fits in what is left of the
+                    window; smaller jobs fill in the end of the window.
+                    ''')
+parser.add_argument('--window-action', choices=['finish', 'suspend', 'checkpoint'], default='finish',
+                    help=
+                    '''
+                    What to do with running encodes when --stop-time arrives. 'finish' lets them run to completion.
+                    'suspend' pauses the encoder and continues it when the next window opens. 'checkpoint' encodes
+                    in segments of --checkpoint-segment seconds, stops at the window edge, and resumes from the
+                    finished segments in the next window.
+                    ''')
+parser.add_argument('--checkpoint-segment', type=check_at_least_one, default=600,
+                    help=
+                    '''
+                    With --window-action checkpoint or --resumable, the length of each segment in seconds.
+                    ''')
+parser.add_argument('--status-file',
+                    help=
+                    '''
+                    Write the progress of running encodes and the estimated time to finish the library
+                    to this file as JSON every --progress-interval seconds.
+                    ''')
+parser.add_argument('--progress-interval', type=check_at_least_one, default=60,
+                    help=
+                    '''
+                    How often to print the fps, speed, size and ETA of running encodes, in seconds.
+                    ''')
+parser.add_argument('--min-savings', type=float,
+                    help=
+                    '''
+                    Abandon encodes whose output is on course to be less than this many percent smaller than
+                    the source, judged from the output size so far once a couple of minutes have been
+                    encoded. With --probe-cache, abandoned files are remembered and skipped until they change.
+                    ''')
+parser.add_argument('--copy-hevc-below', type=check_at_least_one, metavar='KBPS',
+                    help=
+                    '''
+                    Sources whose video is already HEVC at no more than this many kbit/s are remuxed with the
+                    video stream copied instead of being encoded again. Audio is copied too when MP4 can
+                    hold it, and converted to AAC otherwise.
+                    ''')
+parser.add_argument('--profiles', metavar='RULE_FILE',
+                    help=
+                    '''
+                    JSON file of rules that choose the x265 preset, CRF and tune for each source from its
+                    resolution, frame rate, bit rate, duration and codec; the first matching rule wins. With
+                    --start-time or --stop-time, presets are stepped down to faster ones when an encode would
+                    not otherwise finish before the window closes. Without it, libx265's defaults are used.
+                    ''')
+parser.add_argument('--target-vmaf', type=float,
+                    help=
+                    '''
+                    Before each encode, encode a few 10 second samples at each of --crf-candidates and use
+                    the highest CRF whose samples score at least this VMAF. Needs ffmpeg built with libvmaf.
+                    With --probe-cache, the choice is remembered so a restarted conversion skips the search.
+                    ''')
+parser.add_argument('--target-size', type=float, metavar='PERCENT',
+                    help=
+                    '''
+                    Like --target-vmaf, but use the lowest CRF whose samples come out at no more than this
+                    percentage of the source's size. Both targets can be given.
+                    ''')
+parser.add_argument('--crf-candidates', type=lambda value: [int(crf) for crf in value.split(',')],
+                    default='18,20,22,24,26,28',
+                    help=
+                    '''
+                    Comma-separated CRFs for --target-vmaf and --target-size to choose from.
+                    ''')
+parser.add_argument('--move-workers', type=check_at_least_one, default=2,
+                    help=
+                    '''
+                    When --tmp-dir is on a different filesystem from the destination, finished files are
+                    copied to the destination, verified and removed from --tmp-dir by this many background
+                    threads while the next encodes run.
+                    ''')
+parser.add_argument('--stage-dir',
+                    help=
+                    '''
+                    Local scratch directory. While encodes run, the next --stage-ahead files in the queue are
+                    copied here, and the encoder reads the local copy instead of the source; each copy is
+                    deleted once its file is done. Useful when the library is on a network share.
+                    ''')
+parser.add_argument('--stage-budget', type=float, default=100,
+                    help=
+                    '''
+                    The most space, in GB, that staged copies may take up in --stage-dir.
+                    ''')
+parser.add_argument('--stage-ahead', type=check_at_least_one, default=2,
+                    help=
+                    '''
+                    How many files to stage ahead of the encoders.
+                    ''')
+parser.add_argument('--scan-workers', type=check_at_least_one, default=8,
+                    help=
+                    '''
+                    Number of directories to list at once while scanning the library. Raise it for libraries
+                    on high-latency network filesystems.
+                    ''')
+parser.add_argument('--filter-rules',
+                    help=
+                    '''
+                    JSON file of rules deciding which files are converted: suffixes to include and exclude,
+                    directories to skip, path globs and regexes, size and age limits, and source codecs to
+                    include or exclude. See CandidateFilter for the format. Any rule it leaves out keeps its
+                    default.
+                    ''')
+parser.add_argument('--salvage-mode', choices=['stream', 'file'], default='stream',
+                    help=
+                    '''
+                    How a damaged source that fails to encode is salvaged. 'stream' pipes a remux of the source
+                    straight into the encoder; 'file' writes the remux to --tmp-dir first and encodes that, which
+                    needs space for a full copy of the source but lets ffmpeg probe the repaired file.
+                    ''')
+parser.add_argument('--metrics-port', type=check_at_least_one,
+                    help=
+                    '''
+                    Serve Prometheus/OpenMetrics metrics at http://<--metrics-address>:<port>/metrics: queue depth
+                    and bytes, files converted and failed, bytes saved, encode fps and speed, probe and scan
+                    latency, time spent waiting for the encoding window, and retries by phase.
+                    ''')
+parser.add_argument('--metrics-address', default='127.0.0.1',
+                    help=
+                    '''
+                    Address for --metrics-port to listen on.
+                    ''')
+parser.add_argument('--resumable', action='store_true',
+                    help=
+                    '''
+                    Encode in segments of --checkpoint-segment seconds and keep a journal next to them, so a
+                    conversion interrupted by a crash or by the stop file only re-encodes the missing segments
+                    when the tool is restarted. The stop file stops running encodes at once instead of waiting
+                    for them to finish. Interrupted encodes are converted first. Requires --tmp-dir, which is
+                    where the segments and journals are kept and looked for at startup.
+                    ''')
 args = parser.parse_args()
+if args.resumable and args.tmp_dir is None:
+    parser.error('--resumable requires --tmp-dir')
 
 traverser = TreeTraverser.TreeTraverser(args.suffix, args.overwrite, args.force, args.dry_run, args.tmp_dir,
                                         args.flat_dest, args.preserve_source, args.start_time, args.stop_time,
-                                        args.stop_when_complete, args.refresh, args.error_list_file, args.skip_newer)
-traverser.traverse(args.source, args.destination)
+                                        args.stop_when_complete, args.refresh, args.error_list_file, args.skip_newer,
+                                        args.probe_cache, args.jobs, args.schedule_cpus, args.cpu_affinity,
+                                        args.scan_index, args.reconcile_interval, args.poll_interval,
+                                        args.segments, int(args.segment_min_size * 1024 * 1024 * 1024),
+                                        args.segment_min_duration, args.queue_policy, args.throughput_history,
+                                        args.window_action, args.checkpoint_segment, args.resumable,
+                                        args.status_file, args.progress_interval, args.min_savings,
+                                        None if args.copy_hevc_below is None else args.copy_hevc_below * 1000,
+                                        args.profiles, args.target_vmaf, args.target_size, args.crf_candidates,
+                                        args.move_workers, args.stage_dir, int(args.stage_budget * 1024 * 1024 * 1024),
+                                        args.stage_ahead, args.scan_workers, args.filter_rules,
+                                        args.salvage_mode)
+if args.metrics_port is not None:
+    metricsExporter.serve(args.metrics_port, args.metrics_address)
+if args.watch:
+    traverser.watch(args.source, args.destination)
+else:
+    traverser.traverse(args.source, args.destination)
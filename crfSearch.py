@@ -0,0 +1,202 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import concurrent.futures
+import datetime
+import hashlib
+import queue
+import re
+import shutil
+import subprocess
+
+import encodeProfiles
+
+
+class CrfSearch:
+    """
+    Picks a CRF for one source by encoding a few short samples of it at each candidate CRF, in
+    parallel, and measuring them. With a VMAF target, the highest CRF whose samples average at
+    least that score wins, which is the cheapest that looks good enough; VMAF needs an ffmpeg built
+    with libvmaf. With a size target, given as the most the output may be as a percentage of the
+    source, the lowest CRF that fits wins. With both, a CRF has to meet both.
+
+    The choice is kept in the probe cache, when there is one, by path, size and mtime, so a source
+    is only searched once.
+    """
+
+    converter = None
+    target_vmaf = None
+    target_size = None
+    crfs = [18, 20, 22, 24, 26, 28]
+    sample_count = 4
+    sample_seconds = 10
+    parallel = 4
+    vmaf_available = None
+
+    def __init__(self, converter, target_vmaf=None, target_size=None, crfs=None, sample_count=4,
+                 sample_seconds=10, parallel=4):
+        self.converter = converter
+        self.target_vmaf = target_vmaf
+        self.target_size = target_size
+        if crfs is not None:
+            self.crfs = sorted(crfs)
+        self.sample_count = sample_count
+        self.sample_seconds = sample_seconds
+        self.parallel = parallel
+
+    @property
+    def enabled(self):
+        return self.target_vmaf is not None or self.target_size is not None
+
+    def settings(self):
+        """
+        What the search was asked for, so a cached choice is only reused for the same question.
+        """
+        return f'vmaf={self.target_vmaf}:size={self.target_size}:crfs={self.crfs}:' \
+               f'samples={self.sample_count}x{self.sample_seconds}'
+
+    def check_vmaf(self):
+        if CrfSearch.vmaf_available is None:
+            try:
+                result = subprocess.run(['ffmpeg', '-hide_banner', '-filters'], capture_output=True, text=True)
+                CrfSearch.vmaf_available = 'libvmaf' in result.stdout
+            except OSError:
+                CrfSearch.vmaf_available = False
+            if not CrfSearch.vmaf_available:
+                self.converter.eprint('ffmpeg has no libvmaf filter; CRF search will only use sample sizes.')
+        return CrfSearch.vmaf_available
+
+    def sample_starts(self, media_info):
+        """
+        Sample start times spread evenly through the source, away from the very start and end.
+        """
+        duration = media_info.duration
+        if duration <= self.sample_seconds * self.sample_count:
+            return [0.0]
+        return [duration * (i + 1) / (self.sample_count + 1) for i in range(self.sample_count)]
+
+    def work_dir(self, src_file, tmp_path):
+        key = hashlib.sha1(str(src_file.resolve()).encode()).hexdigest()[:12]
+        return tmp_path.joinpath(f'.{src_file.stem}.crf-{key}')
+
+    def encode_sample(self, src_file, work_dir, media_info, profile, crf, index, start, slots):
+        slot = slots.get()
+        try:
+            return self.encode_sample_in_slot(src_file, work_dir, media_info, profile, crf, index, start, slot)
+        finally:
+            slots.put(slot)
+
+    def encode_sample_in_slot(self, src_file, work_dir, media_info, profile, crf, index, start, slot):
+        sample_file = work_dir.joinpath(f'sample-{crf}-{index}.mkv')
+        command = ['ffmpeg', '-y', '-report']
+        command.extend(self.converter.build_input_options(src_file))
+        command.extend(['-ss', f'{start:.3f}', '-i', src_file, '-t', str(self.sample_seconds),
+                        '-map', '0:v:0', '-an', '-sn', '-dn'])
+        sample_profile = encodeProfiles.Profile(profile.preset, crf, profile.tune)
+        command.extend(self.converter.build_video_options(media_info, slot, sample_profile))
+        command.extend(['-f', 'matroska', sample_file])
+        output, _ = self.converter.run_ffmpeg(command, work_dir, f'crf-{crf}-sample-{index}', slot)
+        if output.returncode != 0 or not sample_file.exists():
+            return None, None
+        size = sample_file.stat().st_size
+        vmaf = None
+        if self.target_vmaf is not None and self.check_vmaf():
+            vmaf = self.measure_vmaf(src_file, work_dir, sample_file, start, f'crf-{crf}-vmaf-{index}', slot)
+        return size, vmaf
+
+    def measure_vmaf(self, src_file, work_dir, sample_file, start, phase, slot=None):
+        command = ['ffmpeg', '-y', '-report', '-i', sample_file]
+        command.extend(self.converter.build_input_options(src_file))
+        command.extend(['-ss', f'{start:.3f}', '-t', str(self.sample_seconds), '-i', src_file,
+                        '-lavfi', '[0:v]setpts=PTS-STARTPTS[distorted];[1:v]setpts=PTS-STARTPTS[reference];'
+                                  '[distorted][reference]libvmaf',
+                        '-f', 'null', '-'])
+        output, log_file = self.converter.run_ffmpeg(command, work_dir, phase, slot)
+        if output.returncode != 0:
+            return None
+        try:
+            match = re.search(r'VMAF score: ([0-9.]+)', log_file.read_text(errors='ignore'))
+        except OSError:
+            return None
+        return float(match.group(1)) if match else None
+
+    def measure(self, src_file, work_dir, media_info, profile, slot=None):
+        """
+        Samples run self.parallel at a time, each on its share of slot, so the search stays within
+        the job's thread budget and CPUs.
+        :return: {crf: (size ratio, mean VMAF or None)} for every CRF whose samples all encoded.
+        """
+        starts = self.sample_starts(media_info)
+        parallel = self.parallel if slot is None else max(1, min(self.parallel, len(slot.cpus)))
+        slots = queue.Queue()
+        for sample_slot in self.converter.segmented_encoder.split_slot(slot, parallel):
+            slots.put(sample_slot)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = {(crf, index): executor.submit(self.encode_sample, src_file, work_dir, media_info, profile,
+                                                     crf, index, start, slots)
+                       for crf in self.crfs for index, start in enumerate(starts)}
+        source_bytes = media_info.video_bit_rate / 8 * min(self.sample_seconds, media_info.duration)
+        results = {}
+        for crf in self.crfs:
+            samples = [futures[(crf, index)].result() for index in range(len(starts))]
+            if any(size is None for size, _ in samples):
+                continue
+            ratio = sum(size for size, _ in samples) / (source_bytes * len(samples))
+            scores = [vmaf for _, vmaf in samples if vmaf is not None]
+            vmaf = sum(scores) / len(scores) if len(scores) == len(samples) else None
+            results[crf] = (ratio, vmaf)
+        return results
+
+    def pick(self, results):
+        use_vmaf = self.target_vmaf is not None and self.vmaf_available
+        if not use_vmaf and self.target_size is None:
+            return None
+        meets = []
+        for crf, (ratio, vmaf) in results.items():
+            if self.target_size is not None and ratio * 100 > self.target_size:
+                continue
+            if use_vmaf and (vmaf is None or vmaf < self.target_vmaf):
+                continue
+            meets.append(crf)
+        if len(meets) == 0:
+            return None
+        if use_vmaf:
+            return max(meets)
+        return min(meets)
+
+    def choose(self, src_file, tmp_path, media_info, profile, slot=None):
+        """
+        :return: The CRF to encode src_file with, or None to keep the profile's.
+        """
+        if media_info is None or not media_info.duration or not media_info.video_bit_rate:
+            return None
+        probe_cache = self.converter.probe_cache
+        src_stat = src_file.stat()
+        if probe_cache is not None:
+            crf = probe_cache.lookup_crf(src_file, src_stat.st_size, src_stat.st_mtime, self.settings())
+            if crf is not None:
+                self.converter.log(f'{datetime.datetime.now()}: Using CRF {crf} from an earlier search.')
+                return crf
+
+        work_dir = self.work_dir(src_file, tmp_path)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        self.converter.log(f'{datetime.datetime.now()}: Searching CRFs {self.crfs} on '
+                           f'{len(self.sample_starts(media_info))} samples of {src_file}...')
+        try:
+            results = self.measure(src_file, work_dir, media_info, profile, slot)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        for crf, (ratio, vmaf) in sorted(results.items()):
+            score = 'unknown' if vmaf is None else f'{vmaf:.2f}'
+            self.converter.log(f'CRF {crf}: {ratio * 100:.1f}% of source, VMAF {score}')
+        crf = self.pick(results)
+        if crf is None:
+            self.converter.log(f'{datetime.datetime.now()}: No CRF met the target.')
+            return None
+        self.converter.log(f'{datetime.datetime.now()}: Chose CRF {crf}.')
+        if probe_cache is not None:
+            probe_cache.store_crf(src_file, src_stat.st_size, src_stat.st_mtime, self.settings(), crf)
+        return crf
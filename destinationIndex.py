@@ -0,0 +1,82 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import os
+import threading
+
+
+class DestinationIndex:
+    """
+    In-memory index of the files in destination directories, so checking whether a source has
+    already been converted is a set lookup instead of a stat of the output path, which is a round
+    trip when the destination is on a network share.
+
+    A directory is listed with one scandir the first time it is asked about. After new_pass(), each
+    directory is stat'ed once when next asked about, and only listed again if its mtime changed.
+    Outputs this process writes are added as they land, so they are known without a new listing.
+    """
+
+    directories = {}
+    checked = set()
+    lock = None
+    directories_listed = 0
+
+    def __init__(self):
+        self.directories = {}
+        self.checked = set()
+        self.lock = threading.Lock()
+
+    def new_pass(self):
+        """
+        Start a new pass over the library: every directory is checked for changes when next used.
+        """
+        with self.lock:
+            self.checked = set()
+            self.directories_listed = 0
+
+    def refresh(self, directory):
+        """
+        Check directory for changes when it is next used, without waiting for a new pass.
+        """
+        with self.lock:
+            self.checked.discard(os.fspath(directory))
+
+    def names(self, directory):
+        """
+        :return: The set of names in directory; empty if it doesn't exist. Call with the lock held.
+        """
+        if directory in self.checked:
+            return self.directories[directory][1]
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        cached = self.directories.get(directory)
+        if cached is None or cached[0] != mtime_ns:
+            names = set()
+            if mtime_ns is not None:
+                try:
+                    with os.scandir(directory) as entries:
+                        names = {entry.name for entry in entries}
+                except OSError:
+                    pass
+            self.directories_listed += 1
+            cached = (mtime_ns, names)
+            self.directories[directory] = cached
+        self.checked.add(directory)
+        return cached[1]
+
+    def exists(self, path):
+        directory, name = os.path.split(os.fspath(path))
+        with self.lock:
+            return name in self.names(directory)
+
+    def add(self, path):
+        directory, name = os.path.split(os.fspath(path))
+        with self.lock:
+            cached = self.directories.get(directory)
+            if cached is not None:
+                cached[1].add(name)
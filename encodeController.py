@@ -0,0 +1,90 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import datetime
+import signal
+import subprocess
+import time
+
+
+class EncodeInterrupted(Exception):
+    """
+    Raised when an encode was stopped at a checkpoint so it can be picked up again later.
+    """
+
+
+class EncodeController:
+    """
+    Supervises running ffmpeg processes and keeps them inside the encoding window. When the window
+    closes, an encoder is either suspended with SIGSTOP and continued with SIGCONT when the next
+    window opens, or, with the 'checkpoint' action, stopped so that the finished segments of a
+    segmented encode are kept and the rest is done in a later window. With 'finish', the window
+    is ignored.
+
+    If should_stop is given, an encoder is also stopped at a checkpoint as soon as it returns True.
+    """
+
+    actions = ['finish', 'suspend', 'checkpoint']
+
+    in_window = None
+    should_stop = None
+    action = 'suspend'
+    check_interval = 30
+
+    def __init__(self, in_window, action='suspend', check_interval=30, should_stop=None):
+        """
+        :param in_window: Callable that returns True while encoding is allowed.
+        :param should_stop: Optional callable that returns True when encoding should stop for good.
+        """
+        self.in_window = in_window
+        self.action = action
+        self.check_interval = check_interval
+        self.should_stop = should_stop
+
+    @property
+    def checkpointing(self):
+        return self.action == 'checkpoint'
+
+    def stop(self, process):
+        process.terminate()
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def supervise(self, process, log):
+        """
+        Wait for process to finish, suspending or stopping it whenever the window is closed.
+        :return: The process's return code.
+        """
+        while True:
+            try:
+                return process.wait(timeout=self.check_interval)
+            except subprocess.TimeoutExpired:
+                pass
+            if self.should_stop is not None and self.should_stop():
+                log(f'{datetime.datetime.now()}: Stop requested; stopping encoder {process.pid} at a checkpoint.')
+                self.stop(process)
+                raise EncodeInterrupted('stop requested')
+            if self.action == 'finish' or self.in_window():
+                continue
+
+            if self.checkpointing:
+                log(f'{datetime.datetime.now()}: Encoding window closed; stopping encoder {process.pid} at a checkpoint.')
+                self.stop(process)
+                raise EncodeInterrupted('encoding window closed')
+
+            log(f'{datetime.datetime.now()}: Encoding window closed; suspending encoder {process.pid}.')
+            process.send_signal(signal.SIGSTOP)
+            try:
+                while not self.in_window():
+                    if self.should_stop is not None and self.should_stop():
+                        break
+                    time.sleep(self.check_interval)
+            finally:
+                process.send_signal(signal.SIGCONT)
+            log(f'{datetime.datetime.now()}: Encoding window open; resumed encoder {process.pid}.')
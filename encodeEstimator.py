@@ -0,0 +1,162 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import json
+import threading
+
+from pathlib import Path
+
+
+class Estimate:
+    """
+    What converting one source is expected to cost and save.
+    """
+
+    encode_seconds = None
+    output_size = None
+    savings = None
+
+    def __init__(self, encode_seconds, output_size, savings):
+        self.encode_seconds = encode_seconds
+        self.output_size = output_size
+        self.savings = savings
+
+    def savings_rate(self):
+        """
+        Bytes saved per second of encoding.
+        """
+        return self.savings / max(self.encode_seconds, 1)
+
+    def __repr__(self):
+        return f'Estimate({self.encode_seconds:.0f}s, {self.output_size} bytes, saves {self.savings} bytes)'
+
+
+class EncodeEstimator:
+    """
+    Rough predictions of encode time and output size from probe data. Encode speed is learned from
+    finished encodes, per source codec and resolution class, and can be kept in a history file
+    across runs.
+    """
+
+    # Encoded pixels per second for libx265 at default settings on a typical core budget.
+    pixels_per_second = 25_000_000
+    default_frame_rate = 30
+    # Target bits per pixel for the HEVC output at default CRF.
+    output_bits_per_pixel = 0.05
+    # Fraction of the source size the output is likely to be, by source codec.
+    codec_ratios = {
+        'mpeg1video': 0.25,
+        'mpeg2video': 0.25,
+        'wmv1': 0.35,
+        'wmv2': 0.35,
+        'wmv3': 0.35,
+        'vc1': 0.4,
+        'msmpeg4v3': 0.35,
+        'mpeg4': 0.4,
+        'h264': 0.5,
+        'vp8': 0.6,
+        'vp9': 0.9,
+        'hevc': 0.95,
+        'av1': 1.0
+    }
+    default_codec_ratio = 0.5
+    # Sources whose video is copied rather than encoded are limited by I/O.
+    copy_bytes_per_second = 100_000_000
+    # Weight given to the newest observation when updating a learned rate.
+    smoothing = 0.3
+
+    history_file = None
+    rates = {}
+    lock = None
+
+    def __init__(self, history_file=None):
+        self.lock = threading.Lock()
+        self.rates = {}
+        if history_file is not None:
+            self.history_file = Path(history_file).expanduser()
+            if self.history_file.exists():
+                try:
+                    self.rates = json.loads(self.history_file.read_text())
+                except (OSError, json.JSONDecodeError):
+                    self.rates = {}
+
+    def resolution_class(self, media_info):
+        height = media_info.height or 0
+        if height > 1440:
+            return 'uhd'
+        if height > 720:
+            return 'fhd'
+        if height > 480:
+            return 'hd'
+        return 'sd'
+
+    def rate_keys(self, media_info):
+        """
+        Keys to look learned rates up by, most specific first.
+        """
+        if media_info is None or media_info.video_codec is None:
+            return ['all']
+        codec = media_info.video_codec
+        return [f'{codec}:{self.resolution_class(media_info)}', codec, 'all']
+
+    def learned_rate(self, media_info):
+        with self.lock:
+            for key in self.rate_keys(media_info):
+                if key in self.rates:
+                    return self.rates[key]
+        return self.pixels_per_second
+
+    def record(self, media_info, seconds):
+        """
+        Learn from a finished encode that took seconds of wall time.
+        """
+        pixels = self.pixels(media_info)
+        if pixels is None or seconds <= 0:
+            return
+        rate = pixels / seconds
+        with self.lock:
+            for key in self.rate_keys(media_info):
+                if key in self.rates:
+                    self.rates[key] = self.smoothing * rate + (1 - self.smoothing) * self.rates[key]
+                else:
+                    self.rates[key] = rate
+            if self.history_file is not None:
+                try:
+                    self.history_file.parent.mkdir(parents=True, exist_ok=True)
+                    self.history_file.write_text(json.dumps(self.rates, indent=2, sort_keys=True))
+                except OSError:
+                    pass
+
+    def pixels(self, media_info):
+        if media_info is None or not media_info.duration or not media_info.width or not media_info.height:
+            return None
+        frame_rate = media_info.video.frame_rate or self.default_frame_rate
+        return media_info.duration * frame_rate * media_info.width * media_info.height
+
+    def encode_seconds(self, media_info, size):
+        pixels = self.pixels(media_info)
+        if pixels is None:
+            # Without probe data, assume a 1080p source at 10 Mbit/s.
+            duration = size * 8 / 10_000_000
+            pixels = duration * self.default_frame_rate * 1920 * 1080
+        return pixels / self.learned_rate(media_info)
+
+    def output_size(self, media_info, size):
+        ratio = self.default_codec_ratio
+        if media_info is not None and media_info.video_codec in self.codec_ratios:
+            ratio = self.codec_ratios[media_info.video_codec]
+        estimate = size * ratio
+        pixels = self.pixels(media_info)
+        if pixels is not None:
+            estimate = min(estimate, pixels * self.output_bits_per_pixel / 8)
+        return int(estimate)
+
+    def copy_estimate(self, size):
+        return Estimate(size / self.copy_bytes_per_second, size, 0)
+
+    def estimate(self, media_info, size):
+        output_size = self.output_size(media_info, size)
+        return Estimate(self.encode_seconds(media_info, size), output_size, max(size - output_size, 0))
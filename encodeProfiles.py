@@ -0,0 +1,151 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import json
+
+from pathlib import Path
+
+
+# x265 presets from fastest to slowest, with rough encode speed relative to medium.
+preset_speeds = {
+    'ultrafast': 6.0,
+    'superfast': 5.0,
+    'veryfast': 3.5,
+    'faster': 2.2,
+    'fast': 1.5,
+    'medium': 1.0,
+    'slow': 0.5,
+    'slower': 0.25,
+    'veryslow': 0.1,
+    'placebo': 0.03
+}
+presets = list(preset_speeds)
+
+
+class Profile:
+    """
+    The x265 settings for one source. Unset fields are left to libx265's defaults.
+    """
+
+    preset = None
+    crf = None
+    tune = None
+
+    def __init__(self, preset=None, crf=None, tune=None):
+        self.preset = preset
+        self.crf = crf
+        self.tune = tune
+
+    def ffmpeg_options(self):
+        options = []
+        if self.preset is not None:
+            options.extend(['-preset', self.preset])
+        if self.crf is not None:
+            options.extend(['-crf', str(self.crf)])
+        if self.tune is not None:
+            options.extend(['-tune', self.tune])
+        return options
+
+    def __repr__(self):
+        return f'Profile(preset={self.preset}, crf={self.crf}, tune={self.tune})'
+
+
+class ProfileEngine:
+    """
+    Picks a Profile for each source from a JSON rule file. The file holds a list of rules; the
+    first whose match conditions all hold for the probed source wins:
+
+        [
+            {"match": {"max_height": 576}, "preset": "fast", "crf": 24},
+            {"match": {"min_height": 1500}, "preset": "slow", "crf": 20, "fastest_preset": "fast"},
+            {"match": {"codec": ["mpeg2video"], "max_fps": 30}, "crf": 22, "tune": "grain"},
+            {"preset": "medium", "crf": 22}
+        ]
+
+    Match conditions are min_/max_ height, width, fps, bit_rate (bits per second) and duration
+    (seconds), and codec, a list of source codec names.
+
+    If window_remaining and estimate_seconds are set, the preset is stepped down to faster ones,
+    no further than the rule's fastest_preset, until the encode is expected to fit in what is left
+    of the encoding window.
+    """
+
+    rules = []
+    window_remaining = None
+    estimate_seconds = None
+    fastest_preset = 'veryfast'
+
+    def __init__(self, rule_file=None):
+        self.rules = []
+        if rule_file is not None:
+            self.rules = json.loads(Path(rule_file).expanduser().read_text())
+            for rule in self.rules:
+                for key in ('preset', 'fastest_preset'):
+                    if key in rule and rule[key] not in preset_speeds:
+                        raise ValueError(f'{rule_file}: unknown x265 preset {rule[key]}')
+
+    @property
+    def enabled(self):
+        return len(self.rules) > 0
+
+    def source_properties(self, media_info):
+        video = media_info.video
+        return {
+            'height': media_info.height,
+            'width': media_info.width,
+            'fps': video.frame_rate if video is not None else None,
+            'bit_rate': media_info.video_bit_rate,
+            'duration': media_info.duration
+        }
+
+    def matches(self, rule, media_info):
+        conditions = rule.get('match', {})
+        properties = self.source_properties(media_info)
+        for key, limit in conditions.items():
+            if key == 'codec':
+                if media_info.video_codec not in limit:
+                    return False
+                continue
+            bound, _, name = key.partition('_')
+            value = properties.get(name)
+            if value is None:
+                return False
+            if bound == 'min' and value < limit:
+                return False
+            if bound == 'max' and value > limit:
+                return False
+        return True
+
+    def choose(self, media_info):
+        """
+        :return: The Profile for a source; an empty one if no rule matches.
+        """
+        if media_info is None:
+            return Profile()
+        for rule in self.rules:
+            if self.matches(rule, media_info):
+                profile = Profile(rule.get('preset'), rule.get('crf'), rule.get('tune'))
+                self.fit_window(profile, media_info, rule.get('fastest_preset', self.fastest_preset))
+                return profile
+        return Profile()
+
+    def fit_window(self, profile, media_info, fastest_preset):
+        """
+        Step the preset down until the encode is expected to finish before the window closes.
+        """
+        if self.window_remaining is None or self.estimate_seconds is None:
+            return
+        remaining = self.window_remaining()
+        if remaining is None:
+            return
+        # The estimate is for medium; scale it to each candidate preset.
+        seconds = self.estimate_seconds(media_info)
+        preset = profile.preset or 'medium'
+        index = presets.index(preset)
+        floor = min(presets.index(fastest_preset), index)
+        while index > floor and seconds / preset_speeds[presets[index]] > remaining:
+            index -= 1
+        profile.preset = presets[index]
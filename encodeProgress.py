@@ -0,0 +1,275 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+
+from pathlib import Path
+
+import metricsExporter
+
+
+class EncodeAbandoned(Exception):
+    """
+    Raised when an encode was stopped because its output was not going to be small enough.
+    """
+
+
+class SizeGuard:
+    """
+    Trips when an encode is writing more bytes per second of media than max_rate, which is what
+    the output can average and still save enough. It is only checked once min_seconds of media,
+    or min_fraction of the run, has been written, since the start of an encode is not representative.
+    Every run of one source shares a guard, so when one segment trips, the others stop too.
+    """
+
+    max_rate = None
+    min_seconds = 120
+    min_fraction = 0.1
+    tripped = False
+    projected_rate = None
+
+    def __init__(self, max_rate, min_seconds=120, min_fraction=0.1):
+        self.max_rate = max_rate
+        self.min_seconds = min_seconds
+        self.min_fraction = min_fraction
+
+    def check(self, job):
+        """
+        :return: True if the guard has tripped, for this job or another one.
+        """
+        if self.tripped:
+            return True
+        if job.out_time is None or job.size is None or not job.is_video_encode():
+            return False
+        sample = self.min_seconds
+        if job.duration is not None:
+            sample = min(max(sample, job.duration * self.min_fraction), job.duration)
+        if job.out_time < sample or job.out_time <= 0:
+            return False
+        rate = job.size / job.out_time
+        if rate > self.max_rate:
+            self.projected_rate = rate
+            self.tripped = True
+        return self.tripped
+
+
+class JobProgress:
+    """
+    The latest state of one running ffmpeg process, as reported by -progress.
+    """
+
+    label = None
+    phase = None
+    duration = None
+    started = None
+    frame = None
+    fps = None
+    speed = None
+    size = None
+    out_time = None
+    finished = False
+    abandoned = False
+    thread = None
+
+    def __init__(self, label, phase, duration=None):
+        self.label = label
+        self.phase = phase
+        self.duration = duration
+        self.started = time.monotonic()
+
+    def update(self, values):
+        """
+        Take in one block of key=value pairs from ffmpeg.
+        """
+        self.frame = parse_number(values.get('frame'), int, self.frame)
+        self.fps = parse_number(values.get('fps'), float, self.fps)
+        self.size = parse_number(values.get('total_size'), int, self.size)
+        speed = values.get('speed', '').rstrip('x')
+        self.speed = parse_number(speed, float, self.speed)
+        # out_time_us is missing from older ffmpeg versions; out_time_ms is in microseconds too.
+        out_time = values.get('out_time_us', values.get('out_time_ms'))
+        out_time = parse_number(out_time, int, None)
+        if out_time is not None:
+            self.out_time = out_time / 1_000_000
+        self.finished = values.get('progress') == 'end'
+
+    def is_video_encode(self):
+        """
+        True for runs that encode video, as opposed to copies, audio and concatenation.
+        """
+        return self.phase.startswith('encode') or (self.phase.startswith('segment-') and self.phase[8:].isdigit())
+
+    def eta(self):
+        """
+        Seconds until this process is done, or None if it can't be told yet.
+        """
+        if self.duration is None or self.out_time is None or not self.speed:
+            return None
+        return max(self.duration - self.out_time, 0) / self.speed
+
+    def to_json(self):
+        return {
+            'label': self.label,
+            'phase': self.phase,
+            'frame': self.frame,
+            'fps': self.fps,
+            'speed': self.speed,
+            'size': self.size,
+            'out_time': self.out_time,
+            'duration': self.duration,
+            'eta': self.eta(),
+            'elapsed': time.monotonic() - self.started
+        }
+
+
+def parse_number(value, kind, default):
+    if value is None or value in ('', 'N/A'):
+        return default
+    try:
+        return kind(value)
+    except ValueError:
+        return default
+
+
+def eta_string(seconds):
+    if seconds is None:
+        return 'unknown'
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class ProgressMonitor:
+    """
+    Collects -progress output from every running ffmpeg process. Every interval seconds, one line
+    per job goes to the console and the whole picture, including an ETA for the library, is written
+    to status_file as JSON.
+
+    library_status, if set, is a callable returning (files, bytes) still queued. The library ETA is
+    those bytes divided by the rate sources have been converted at so far.
+    """
+
+    converter = None
+    status_file = None
+    interval = 60
+    library_status = None
+    lock = None
+    jobs = {}
+    last_report = 0
+    started = None
+    converted_bytes = 0
+
+    def __init__(self, converter, status_file=None, interval=60):
+        self.converter = converter
+        if status_file is not None:
+            self.status_file = Path(status_file).expanduser()
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.started = time.monotonic()
+        self.last_report = self.started
+
+    def watch(self, process, label, phase, duration=None, guard=None):
+        """
+        Read process's progress stream on a background thread until it closes. If guard trips,
+        the process is terminated and the job is marked abandoned.
+        :return: The JobProgress; the caller should join its thread after the process exits.
+        """
+        job = JobProgress(label, phase, duration)
+        with self.lock:
+            self.jobs[id(job)] = job
+        job.thread = threading.Thread(target=self.read, args=(process, job, guard), daemon=True)
+        job.thread.start()
+        return job
+
+    def read(self, process, job, guard=None):
+        stream = process.stdout
+        values = {}
+        try:
+            for line in stream:
+                key, _, value = line.decode(errors='ignore').strip().partition('=')
+                values[key] = value
+                if key == 'progress':
+                    job.update(values)
+                    values = {}
+                    if guard is not None and not job.abandoned and guard.check(job):
+                        job.abandoned = True
+                        process.terminate()
+                    self.maybe_report()
+        except (OSError, ValueError):
+            pass
+        finally:
+            stream.close()
+            with self.lock:
+                self.jobs.pop(id(job), None)
+            if job.finished and job.is_video_encode():
+                if job.fps is not None:
+                    metricsExporter.encode_fps.observe(job.fps)
+                if job.speed is not None:
+                    metricsExporter.encode_speed.observe(job.speed)
+
+    def record_converted(self, size):
+        """
+        Count size bytes of source as done, for the library ETA.
+        """
+        with self.lock:
+            self.converted_bytes += size
+
+    def library_eta(self, queued_bytes):
+        elapsed = time.monotonic() - self.started
+        if self.converted_bytes == 0 or elapsed <= 0:
+            return None
+        return queued_bytes / (self.converted_bytes / elapsed)
+
+    def maybe_report(self):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_report < self.interval:
+                return
+            self.last_report = now
+        self.report()
+
+    def report(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            prefix = '' if job.label is None else f'[{job.label}] '
+            fps = 'unknown' if job.fps is None else f'{job.fps:.1f}'
+            speed = 'unknown' if job.speed is None else f'{job.speed:.2f}x'
+            size = self.converter.size_string(job.size or 0)
+            print(f'{prefix}{datetime.datetime.now()}: {job.phase}: {fps} fps, {speed}, {size} written, '
+                  f'ETA {eta_string(job.eta())}')
+
+        library = None
+        if self.library_status is not None:
+            files, queued_bytes = self.library_status()
+            library = {
+                'queued_files': files,
+                'queued_bytes': queued_bytes,
+                'converted_bytes': self.converted_bytes,
+                'eta': self.library_eta(queued_bytes)
+            }
+            print(f'{datetime.datetime.now()}: {files} files ({self.converter.size_string(queued_bytes)}) queued; '
+                  f'library ETA {eta_string(library["eta"])}')
+        self.write_status(jobs, library)
+
+    def write_status(self, jobs, library):
+        if self.status_file is None:
+            return
+        status = {
+            'updated': datetime.datetime.now().isoformat(),
+            'jobs': [job.to_json() for job in jobs],
+            'library': library
+        }
+        partial_file = self.status_file.with_name(self.status_file.name + '.partial')
+        try:
+            self.status_file.parent.mkdir(parents=True, exist_ok=True)
+            partial_file.write_text(json.dumps(status, indent=2))
+            os.replace(partial_file, self.status_file)
+        except OSError:
+            pass
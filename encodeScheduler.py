@@ -0,0 +1,116 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import os
+import threading
+
+
+class EncodeSlot:
+    """
+    The share of the machine one encode is allowed to use.
+    """
+
+    threads = 1
+    frame_threads = 1
+    cpus = []
+    pin = False
+
+    def __init__(self, threads, cpus, pin=False):
+        self.threads = threads
+        self.cpus = cpus
+        self.pin = pin
+        if threads >= 16:
+            self.frame_threads = 4
+        elif threads >= 8:
+            self.frame_threads = 3
+        elif threads >= 4:
+            self.frame_threads = 2
+        else:
+            self.frame_threads = 1
+
+    def x265_params(self):
+        return f'pools={self.threads}:frame-threads={self.frame_threads}'
+
+    def apply_affinity(self, pid):
+        """
+        Pin a running process to this slot's CPUs. Does nothing if the slot isn't pinned.
+        """
+        if not self.pin or not hasattr(os, 'sched_setaffinity'):
+            return
+        try:
+            os.sched_setaffinity(pid, self.cpus)
+        except OSError:
+            pass
+
+    def __repr__(self):
+        return f'EncodeSlot({self.threads} threads, cpus={self.cpus}, pin={self.pin})'
+
+
+class EncodeScheduler:
+    """
+    Hands out CPU budgets to concurrent encodes so that together they never ask for more cores
+    than the machine has. Budgets are sized from the source resolution; a job blocks in acquire()
+    until enough cores are free.
+    """
+
+    cpus = []
+    free_cpus = []
+    use_affinity = False
+    condition = None
+
+    # (minimum pixels per frame, threads). The first row the source reaches wins.
+    thread_budgets = [
+        (2560 * 1440, 16),
+        (1280 * 720 + 1, 8),
+        (0, 4)
+    ]
+
+    def __init__(self, use_affinity=False):
+        if hasattr(os, 'sched_getaffinity'):
+            self.cpus = sorted(os.sched_getaffinity(0))
+        else:
+            self.cpus = list(range(os.cpu_count() or 1))
+        self.free_cpus = list(self.cpus)
+        self.use_affinity = use_affinity
+        self.condition = threading.Condition()
+
+    def core_count(self):
+        return len(self.cpus)
+
+    def max_jobs(self):
+        """
+        The most encodes that can run at once, which is when every source is at the smallest budget.
+        """
+        smallest = min(self.threads_for(None), self.core_count())
+        return max(1, self.core_count() // smallest)
+
+    def threads_for(self, media_info):
+        pixels = 0
+        if media_info is not None and media_info.width and media_info.height:
+            pixels = media_info.width * media_info.height
+        for minimum_pixels, threads in self.thread_budgets:
+            if pixels >= minimum_pixels:
+                return min(threads, self.core_count())
+        return min(self.thread_budgets[-1][1], self.core_count())
+
+    def acquire(self, media_info):
+        """
+        Block until there are enough free cores for this source, then reserve them.
+        :return: An EncodeSlot that must be handed back with release().
+        """
+        threads = self.threads_for(media_info)
+        with self.condition:
+            while len(self.free_cpus) < threads:
+                self.condition.wait()
+            cpus = self.free_cpus[:threads]
+            del self.free_cpus[:threads]
+        return EncodeSlot(threads, cpus, self.use_affinity)
+
+    def release(self, slot):
+        with self.condition:
+            self.free_cpus.extend(slot.cpus)
+            self.free_cpus.sort()
+            self.condition.notify_all()
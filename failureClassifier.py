@@ -0,0 +1,123 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import re
+
+
+class Diagnosis:
+    """
+    What an ffmpeg report says went wrong. categories holds every failure category found, and
+    markers the first marker seen for each.
+    """
+
+    log_file = None
+    categories = set()
+    markers = {}
+
+    def __init__(self, log_file, markers=None):
+        self.log_file = log_file
+        self.markers = dict(markers or {})
+        self.categories = set(self.markers)
+
+    @property
+    def unreadable_input(self):
+        return 'unreadable-input' in self.categories
+
+    @property
+    def unreadable_transport_stream(self):
+        return 'unreadable-transport-stream' in self.categories
+
+    @property
+    def mux_timestamp_error(self):
+        return 'mux-timestamp' in self.categories
+
+    @property
+    def broken_pipe(self):
+        return 'broken-pipe' in self.categories
+
+    @property
+    def salvageable(self):
+        """
+        A copy remux might get past the failure; there is no point trying when the input can't be read.
+        """
+        return not self.unreadable_input
+
+    def summary(self):
+        if len(self.markers) == 0:
+            return 'no known failure markers'
+        return ', '.join(f"{category} ('{marker}')" for category, marker in sorted(self.markers.items()))
+
+    def __repr__(self):
+        return f'Diagnosis({self.summary()})'
+
+
+class FailureClassifier:
+    """
+    Reads an ffmpeg report once, streaming it line by line, and matches every failure category's
+    markers with one compiled regex. Reports on damaged transport streams can be hundreds of MB,
+    so reading stops as soon as every category has been seen.
+    """
+
+    categories = {
+        'unreadable-input': [
+            'Error opening input file',
+            'Error opening input files:',
+            'Invalid data found when processing input',
+            'moov atom not found',
+            'could not find codec parameters',
+            'Could not detect TS packet size',
+            'End of file'
+        ],
+        'unreadable-transport-stream': [
+            'Error opening input file',
+            'Error opening input files:',
+            'could not find codec parameters',
+            'Could not detect TS packet size',
+            'Invalid data found when processing input'
+        ],
+        'mux-timestamp': [
+            'pts/dts pair unsupported',
+            'Error muxing a packet',
+            'Not yet implemented in FFmpeg, patches welcome'
+        ],
+        'broken-pipe': [
+            'Broken pipe'
+        ]
+    }
+
+    pattern = None
+    marker_categories = {}
+
+    def __init__(self, categories=None):
+        if categories is not None:
+            self.categories = categories
+        self.marker_categories = {}
+        for category, markers in self.categories.items():
+            for marker in markers:
+                self.marker_categories.setdefault(marker.encode(), []).append(category)
+        # Longest first, so a marker that contains another is the one reported.
+        alternatives = sorted(self.marker_categories, key=len, reverse=True)
+        self.pattern = re.compile(b'|'.join(re.escape(marker) for marker in alternatives))
+
+    def classify(self, log_file):
+        """
+        :return: A Diagnosis; it is empty if log_file is missing or can't be read.
+        """
+        found = {}
+        if log_file is None:
+            return Diagnosis(log_file)
+        try:
+            with open(log_file, 'rb') as report:
+                for line in report:
+                    for match in self.pattern.finditer(line):
+                        marker = match.group()
+                        for category in self.marker_categories[marker]:
+                            found.setdefault(category, marker.decode())
+                    if len(found) == len(self.categories):
+                        break
+        except OSError:
+            pass
+        return Diagnosis(log_file, found)
@@ -0,0 +1,228 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import concurrent.futures
+import os
+import sqlite3
+import threading
+
+from pathlib import Path
+
+
+class FileIndex:
+    """
+    Persistent index of the directories and files under a library root. A directory is only
+    listed again when its mtime changes, and only files that are new in a changed directory are
+    stat'ed. Everything else comes from the index.
+
+    Changing a file in place doesn't change its directory's mtime, so callers that notice a file
+    is different from what the index said should call invalidate() on it.
+
+    Directories are visited by a pool of workers threads, since on a network filesystem a scan is
+    bound by round trips rather than by CPU.
+    """
+
+    index_file = None
+    connection = None
+    lock = None
+    workers = 8
+    directories_listed = 0
+    directories_reused = 0
+    files_statted = 0
+
+    def __init__(self, index_file=None, workers=8):
+        self.workers = workers
+        if index_file is None:
+            database = ':memory:'
+        else:
+            self.index_file = Path(index_file).expanduser()
+            self.index_file.parent.mkdir(parents=True, exist_ok=True)
+            database = self.index_file.as_posix()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS directories (
+                    path TEXT PRIMARY KEY,
+                    parent TEXT,
+                    mtime_ns INTEGER NOT NULL
+                )''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent)')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    directory TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    size INTEGER,
+                    mtime REAL,
+                    PRIMARY KEY (directory, name)
+                )''')
+
+    def directory_mtime(self, path):
+        with self.lock:
+            row = self.connection.execute('SELECT mtime_ns FROM directories WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def indexed_files(self, path):
+        """
+        :return: {name: (size, mtime)} for the files recorded in a directory.
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT name, size, mtime FROM files WHERE directory = ?', (path,))
+            return {name: (size, mtime) for name, size, mtime in rows}
+
+    def indexed_subdirectories(self, path):
+        with self.lock:
+            rows = self.connection.execute('SELECT path FROM directories WHERE parent = ?', (path,))
+            return [row[0] for row in rows]
+
+    def forget_directory(self, path):
+        """
+        Drop a directory and everything under it from the index.
+        """
+        prefix = os.path.join(path, '')
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM directories WHERE path = ? OR substr(path, 1, ?) = ?', (path, len(prefix), prefix))
+            self.connection.execute(
+                'DELETE FROM files WHERE directory = ? OR substr(directory, 1, ?) = ?', (path, len(prefix), prefix))
+
+    def invalidate(self, path):
+        """
+        Forget what is known about a file and force its directory to be listed on the next scan.
+        """
+        directory, name = os.path.split(os.fspath(path))
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM files WHERE directory = ? AND name = ?', (directory, name))
+            self.connection.execute('UPDATE directories SET mtime_ns = -1 WHERE path = ?', (directory,))
+
+    def stat_file(self, top, name):
+        try:
+            stat_result = os.stat(os.path.join(top, name))
+        except OSError:
+            return None, None
+        self.files_statted += 1
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE files SET size = ?, mtime = ? WHERE directory = ? AND name = ?',
+                                    (stat_result.st_size, stat_result.st_mtime, top, name))
+        return stat_result.st_size, stat_result.st_mtime
+
+    def refresh_directory(self, top, parent, mtime_ns, want):
+        """
+        List a directory whose mtime changed, stat'ing only files that weren't already indexed.
+        :return: ({name: (size, mtime)}, [subdirectory paths], number of files stat'ed)
+        """
+        statted = 0
+        old_files = self.indexed_files(top)
+        old_subdirectories = set(self.indexed_subdirectories(top))
+        files = {}
+        subdirectories = []
+        with os.scandir(top) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=True)
+                    is_link = entry.is_symlink()
+                except OSError:
+                    continue
+                if is_dir and is_link:
+                    # Like os.walk, links to directories are neither descended into nor treated as files,
+                    # so a link loop can't yield the same file under many paths.
+                    continue
+                if is_dir:
+                    subdirectories.append(entry.path)
+                    continue
+                if entry.name in old_files:
+                    files[entry.name] = old_files[entry.name]
+                    continue
+                if want is not None and not want(entry.path):
+                    files[entry.name] = (None, None)
+                    continue
+                try:
+                    stat_result = entry.stat()
+                except OSError:
+                    continue
+                statted += 1
+                files[entry.name] = (stat_result.st_size, stat_result.st_mtime)
+
+        for gone in old_subdirectories.difference(subdirectories):
+            self.forget_directory(gone)
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM files WHERE directory = ?', (top,))
+            self.connection.executemany(
+                'INSERT INTO files (directory, name, size, mtime) VALUES (?, ?, ?, ?)',
+                [(top, name, size, mtime) for name, (size, mtime) in files.items()])
+            self.connection.execute(
+                'INSERT OR REPLACE INTO directories (path, parent, mtime_ns) VALUES (?, ?, ?)',
+                (top, parent, mtime_ns))
+        return files, subdirectories, statted
+
+    def visit_directory(self, top, parent, want):
+        """
+        Get one directory's files and subdirectories, from the index if it hasn't changed.
+        :return: (files, subdirectories, listed, statted), or None if the directory can't be read.
+        """
+        try:
+            mtime_ns = os.stat(top).st_mtime_ns
+        except OSError:
+            self.forget_directory(top)
+            return None
+
+        if self.directory_mtime(top) == mtime_ns:
+            return self.indexed_files(top), self.indexed_subdirectories(top), False, 0
+        try:
+            files, subdirectories, statted = self.refresh_directory(top, parent, mtime_ns, want)
+        except OSError:
+            return None
+        return files, subdirectories, True, statted
+
+    def scan(self, root, skip_directories=(), want=None):
+        """
+        Walk root, listing only directories that changed since the last scan.
+        :param skip_directories: Directory names that are not descended into.
+        :param want: Optional predicate on a file path; files it rejects are recorded but never stat'ed
+                     or yielded.
+        :return: A generator of (directory, name, size, mtime) for every wanted file. Files are
+                 yielded as their directories are visited, so the caller can start on them before the
+                 walk is over; the order is not defined.
+        """
+        self.directories_listed = 0
+        self.directories_reused = 0
+        self.files_statted = 0
+        root = os.path.normpath(os.fspath(root))
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scan')
+        try:
+            pending = {executor.submit(self.visit_directory, root, None, want): root}
+            while len(pending) > 0:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    top = pending.pop(future)
+                    result = future.result()
+                    if result is None:
+                        continue
+                    files, subdirectories, listed, statted = result
+                    if listed:
+                        self.directories_listed += 1
+                    else:
+                        self.directories_reused += 1
+                    self.files_statted += statted
+
+                    for subdirectory in subdirectories:
+                        if os.path.basename(subdirectory) not in skip_directories:
+                            pending[executor.submit(self.visit_directory, subdirectory, top, want)] = subdirectory
+                    for name in sorted(files):
+                        size, mtime = files[name]
+                        if size is None:
+                            # Recorded without a stat because it wasn't wanted then; the predicate may have
+                            # changed.
+                            if want is None or not want(os.path.join(top, name)):
+                                continue
+                            size, mtime = self.stat_file(top, name)
+                            if size is None:
+                                continue
+                        yield top, name, size, mtime
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,166 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import concurrent.futures
+import datetime
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import threading
+
+from pathlib import Path
+
+
+class FileMover:
+    """
+    Moves finished encodes from the temporary directory to their destination. On the same
+    filesystem that is a rename. Across filesystems, the copy runs on a background thread pool so
+    the next encode can start; the copy is done in the kernel with copy_file_range or sendfile where
+    possible, flushed with fsync, read back and compared by checksum, and only then is the
+    temporary file removed and the caller's on_done run.
+    """
+
+    chunk_size = 64 * 1024 * 1024
+    buffer_size = 8 * 1024 * 1024
+    executor = None
+    lock = None
+    pending = set()
+    futures = []
+
+    def __init__(self, workers=2):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mover')
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.futures = []
+
+    def same_device(self, tmp_file, dest_file):
+        return os.stat(tmp_file).st_dev == os.stat(Path(dest_file).parent).st_dev
+
+    def finalize(self, tmp_file, dest_file, source=None, on_done=None, log=print):
+        """
+        Move tmp_file to dest_file. source is the file being converted; is_pending reports it until
+        the move is over. on_done is called with True once dest_file is in place, or False if the
+        move failed and tmp_file was left where it was.
+        :return: True if the move finished before returning, False if it is running in the background.
+        """
+        tmp_file = Path(tmp_file)
+        dest_file = Path(dest_file)
+        if self.same_device(tmp_file, dest_file):
+            log(f'{datetime.datetime.now()}: Renaming {tmp_file} to {dest_file}.')
+            os.replace(tmp_file, dest_file)
+            if on_done is not None:
+                on_done(True)
+            return True
+
+        log(f'{datetime.datetime.now()}: Moving {tmp_file} to {dest_file} in the background.')
+        key = str(source if source is not None else tmp_file)
+        with self.lock:
+            self.pending.add(key)
+            future = self.executor.submit(self.move, tmp_file, dest_file, key, on_done, log)
+            self.futures = [f for f in self.futures if not f.done()] + [future]
+        return False
+
+    def move(self, tmp_file, dest_file, key, on_done, log):
+        partial_file = dest_file.with_name(f'.{dest_file.name}.partial')
+        moved = False
+        try:
+            self.copy_data(tmp_file, partial_file)
+            if self.checksum(tmp_file) != self.checksum(partial_file, drop_cache=True):
+                raise OSError(errno.EIO, f'checksum of {partial_file} does not match {tmp_file}')
+            os.replace(partial_file, dest_file)
+            self.sync_directory(dest_file.parent)
+            tmp_file.unlink()
+            moved = True
+            log(f'{datetime.datetime.now()}: Moved {tmp_file} to {dest_file}.')
+        except OSError as e:
+            partial_file.unlink(missing_ok=True)
+            print(f'{datetime.datetime.now()}: Could not move {tmp_file} to {dest_file}: {e}', file=sys.stderr)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+        if on_done is not None:
+            on_done(moved)
+
+    def copy_data(self, src, dst):
+        with open(src, 'rb') as source, open(dst, 'wb') as dest:
+            size = os.fstat(source.fileno()).st_size
+            if not self.copy_in_kernel(source, dest, size):
+                source.seek(0)
+                dest.seek(0)
+                dest.truncate()
+                shutil.copyfileobj(source, dest, self.buffer_size)
+            dest.flush()
+            os.fsync(dest.fileno())
+
+    def copy_in_kernel(self, source, dest, size):
+        """
+        :return: True if the whole file was copied; False if neither copy_file_range nor sendfile
+                 can be used between these files, in which case nothing was copied.
+        """
+        for name in ('copy_file_range', 'sendfile'):
+            call = getattr(os, name, None)
+            if call is None:
+                continue
+            copied = 0
+            try:
+                while copied < size:
+                    count = min(self.chunk_size, size - copied)
+                    if name == 'copy_file_range':
+                        written = call(source.fileno(), dest.fileno(), count)
+                    else:
+                        written = call(dest.fileno(), source.fileno(), None, count)
+                    if written == 0:
+                        break
+                    copied += written
+            except OSError as e:
+                if copied == 0 and e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                                               errno.EBADF):
+                    continue
+                raise
+            if copied != size:
+                raise OSError(errno.EIO, f'copied {copied} of {size} bytes')
+            return True
+        return False
+
+    def checksum(self, path, drop_cache=False):
+        digest = hashlib.blake2b()
+        with open(path, 'rb') as file:
+            if drop_cache and hasattr(os, 'posix_fadvise'):
+                # Read back what reached the destination, not what is still in the page cache.
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            while True:
+                block = file.read(self.buffer_size)
+                if not block:
+                    break
+                digest.update(block)
+        return digest.digest()
+
+    def sync_directory(self, directory):
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def is_pending(self, source):
+        with self.lock:
+            return str(source) in self.pending
+
+    def wait(self):
+        """
+        Wait for every background move to finish.
+        """
+        with self.lock:
+            futures = list(self.futures)
+            self.futures = []
+        concurrent.futures.wait(futures)
@@ -4,16 +4,30 @@ Copyright © 2023 Syd Polk
 
 """
 
+import concurrent.futures
 import datetime
-import json
 import os
 import shutil
+import signal
 import subprocess
 import sys
+import threading
 
 from pathlib import Path
 from time import localtime, strftime
 
+import candidateFilter
+import crfSearch
+import encodeController
+import encodeProfiles
+import encodeProgress
+import failureClassifier
+import fileMover
+import metricsExporter
+import mediaProbe
+import probeCache
+import segmentedEncoder
+
 
 class H265Converter:
 
@@ -27,10 +41,51 @@ class H265Converter:
     video_suffixes = []
     default_aac_6ch_layout = None
     default_aac_5ch_layout = None
+    probe_cache = None
+    job_local = None
+    segmented_encoder = None
+    controller = None
+    failure_classifier = None
+    progress = None
+    min_savings = None
+    copy_max_bit_rate = None
+    profiles = None
+    source_profiles = {}
+    profiles_lock = None
+    crf_search = None
+    mover = None
+    destination_index = None
+    failed_moves = set()
+    salvage_mode = 'stream'
+    # Audio codecs that can go into the MP4 output as they are.
+    mp4_audio_codecs = {'aac', 'ac3', 'eac3', 'mp3', 'alac'}
 
     def __init__(self, suffix='.v2.mp4', overwrite=False, force=False, dry_run=False, tmp_dir=None,
-                 preserve_source=False, video_suffixes=[]):
+                 preserve_source=False, video_suffixes=[], probe_cache=None, segments=1,
+                 segment_min_size=20 * 1024 * 1024 * 1024, segment_min_duration=2 * 60 * 60,
+                 controller=None, checkpoint_segment=600, resumable=False, status_file=None, progress_interval=60,
+                 min_savings=None, copy_max_bit_rate=None, profile_file=None, target_vmaf=None, target_size=None,
+                 crf_candidates=None, move_workers=2, salvage_mode='stream'):
         self.suffix = suffix
+        self.salvage_mode = salvage_mode
+        self.mover = fileMover.FileMover(move_workers)
+        self.failed_moves = set()
+        self.crf_search = crfSearch.CrfSearch(self, target_vmaf, target_size, crf_candidates)
+        self.profiles = encodeProfiles.ProfileEngine(profile_file)
+        self.source_profiles = {}
+        self.profiles_lock = threading.Lock()
+        self.copy_max_bit_rate = copy_max_bit_rate
+        self.min_savings = min_savings
+        self.progress = encodeProgress.ProgressMonitor(self, status_file, progress_interval)
+        self.controller = controller
+        self.segmented_encoder = segmentedEncoder.SegmentedEncoder(self, segments, segment_min_size,
+                                                                   segment_min_duration)
+        if resumable or (controller is not None and controller.checkpointing):
+            # Checkpoints and resumes happen at segment boundaries, so every encode is done in segments.
+            self.segmented_encoder.segment_duration = checkpoint_segment
+        self.probe_cache = probe_cache
+        self.failure_classifier = failureClassifier.FailureClassifier()
+        self.job_local = threading.local()
         self.video_suffixes = video_suffixes
         if overwrite:
             self.overwrite_flag = '-y'
@@ -50,72 +105,68 @@ class H265Converter:
         time_str = strftime('%Y%m%d%H%M%S', localtime())
         self.log_name = f'h265Converter-{time_str}.log'
 
-    def run_ffmpeg(self, command, tmp_path, phase):
+    def report_env(self, tmp_path, phase):
         """
-        Run ffmpeg with a unique report file for each invocation so logs are not overwritten.
+        :return: (log_file, env) giving an ffmpeg run a report file of its own, so logs are not overwritten.
         """
         time_str = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
         log_file = tmp_path.joinpath(f'h265Converter-{time_str}-{phase}.log')
         my_env = os.environ.copy()
         my_env["FFREPORT"] = f'file={log_file}:level=32'
-        output = subprocess.run(command, stderr=subprocess.DEVNULL, env=my_env)
-        return output, log_file
+        return log_file, my_env
 
-    def run_audio_probe(self, src_file, force_ts_demux=False):
-        probe_command = ['ffprobe', '-v', 'error']
-        if force_ts_demux:
-            probe_command.extend([
-                '-f', 'mpegts',
-                '-analyzeduration', '100M',
-                '-probesize', '100M'
-            ])
-        probe_command.extend([
-            '-select_streams', 'a:0',
-            '-show_entries', 'stream=channels,channel_layout',
-            '-of', 'json',
-            src_file
-        ])
-        return subprocess.run(probe_command, capture_output=True, text=True)
+    def run_ffmpeg(self, command, tmp_path, phase, slot=None, duration=None, guard=None, stdin=None):
+        """
+        Run ffmpeg with a unique report file for each invocation so logs are not overwritten.
+        Progress is read from ffmpeg's -progress stream; duration, the seconds of media being written,
+        gives the ETA. If a scheduler slot is given, the process is pinned to the slot's CPUs. If there
+        is a controller, it may suspend the process outside the encoding window, or raise EncodeInterrupted.
+        If a SizeGuard is given and trips, the process is stopped and EncodeAbandoned is raised.
+        If stdin is given, it becomes the process's standard input and is closed in this process.
+        """
+        if guard is not None and guard.tripped:
+            raise encodeProgress.EncodeAbandoned(phase)
+        log_file, my_env = self.report_env(tmp_path, phase)
+        command = [command[0], '-nostats', '-progress', 'pipe:1'] + list(command[1:])
+        process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   env=my_env)
+        if stdin is not None:
+            # Only the process may hold the read end, or a writer feeding it never sees it exit.
+            stdin.close()
+        job = self.progress.watch(process, self.job_label(), phase, duration, guard)
+        if slot is not None:
+            slot.apply_affinity(process.pid)
+        try:
+            if self.controller is not None:
+                returncode = self.controller.supervise(process, self.log)
+            else:
+                returncode = process.wait()
+        finally:
+            job.thread.join()
+        if job.abandoned:
+            raise encodeProgress.EncodeAbandoned(phase)
+        output = subprocess.CompletedProcess(command, returncode)
+        return output, log_file
 
-    def run_video_probe(self, src_file, force_ts_demux=False):
-        probe_command = ['ffprobe', '-v', 'error']
-        if force_ts_demux:
-            probe_command.extend([
-                '-f', 'mpegts',
-                '-analyzeduration', '100M',
-                '-probesize', '100M'
-            ])
-        probe_command.extend([
-            '-select_streams', 'v:0',
-            '-show_entries', 'stream=index',
-            '-of', 'json',
-            src_file
-        ])
-        return subprocess.run(probe_command, capture_output=True, text=True)
+    def probe_media(self, src_file, use_cache=True):
+        """
+        Run ffprobe once for a source and return its MediaInfo, or None if it can't be probed.
+        Results come from the probe cache when there is one and the file hasn't changed.
+        """
+        if use_cache and self.probe_cache is not None:
+            return self.probe_cache.probe(Path(src_file))
+        return mediaProbe.probe_media(Path(src_file))
 
-    def detect_audio_layout(self, src_file):
+    def detect_audio_layout(self, media_info):
         """
         Determine the primary audio stream layout so AAC gets a valid channel layout.
         Returns None when no audio stream is present.
         """
-        result = self.run_audio_probe(src_file)
-        if result.returncode != 0 and Path(src_file).suffix.lower() in {'.ts', '.m2ts'}:
-            result = self.run_audio_probe(src_file, force_ts_demux=True)
-        if result.returncode != 0:
-            return None
-
-        try:
-            probe_data = json.loads(result.stdout)
-        except json.JSONDecodeError:
-            return None
-
-        streams = probe_data.get('streams', [])
-        if len(streams) == 0:
+        if media_info is None or not media_info.has_audio:
             return None
 
-        stream = streams[0]
-        channels = stream.get('channels')
-        channel_layout = stream.get('channel_layout')
+        channels = media_info.channels
+        channel_layout = media_info.channel_layout
         if channel_layout and channel_layout != 'unknown':
             return channel_layout
 
@@ -127,24 +178,64 @@ class H265Converter:
 
         return None
 
-    def has_video_stream(self, src_file):
-        result = self.run_video_probe(src_file)
-        if result.returncode != 0 and Path(src_file).suffix.lower() in {'.ts', '.m2ts'}:
-            result = self.run_video_probe(src_file, force_ts_demux=True)
-        if result.returncode != 0:
-            return False
-        try:
-            probe_data = json.loads(result.stdout)
-        except json.JSONDecodeError:
+    def has_video_stream(self, media_info):
+        return media_info is not None and media_info.has_video
+
+    def can_copy_video(self, media_info):
+        """
+        True if the video is already HEVC at no more than copy_max_bit_rate, so it is remuxed
+        rather than encoded again. Off unless copy_max_bit_rate is set.
+        """
+        if self.copy_max_bit_rate is None or media_info is None or media_info.video_codec != 'hevc':
             return False
-        streams = probe_data.get('streams', [])
-        return len(streams) > 0
+        bit_rate = media_info.video_bit_rate
+        return bit_rate is not None and bit_rate <= self.copy_max_bit_rate
+
+    def can_copy_audio(self, media_info):
+        return media_info is not None and media_info.audio is not None and \
+            media_info.audio.codec_name in self.mp4_audio_codecs
+
+    def profile_for(self, src_file, media_info):
+        """
+        The Profile chosen for src_file when its conversion started, so every segment and retry of
+        one source is encoded the same way.
+        """
+        with self.profiles_lock:
+            profile = self.source_profiles.get(str(src_file))
+        if profile is None:
+            profile = self.profiles.choose(media_info)
+        return profile
+
+    def job_profile(self):
+        """
+        The Profile of the conversion running on the calling thread, or None.
+        """
+        return getattr(self.job_local, 'profile', None)
+
+    def build_video_options(self, media_info, slot=None, profile=None):
+        options = ['-c:v', 'libx265', '-pix_fmt', 'yuv420p']
+        if profile is not None:
+            options.extend(profile.ffmpeg_options())
+        if slot is not None:
+            options.extend(['-x265-params', slot.x265_params()])
+        return options
+
+    def build_audio_options(self, media_info, repair_audio_timestamps=False):
+        audio_layout = self.detect_audio_layout(media_info)
+        options = ['-c:a', 'aac']
+        if repair_audio_timestamps:
+            options.extend(['-af', 'aresample=async=1:first_pts=0', '-ar', '48000'])
+        if audio_layout is not None:
+            options.extend(['-channel_layout', audio_layout])
+        return options
 
     def build_encode_command(self, src_file, tmp_file, force_ts_demux=False,
-                             repair_audio_timestamps=False, disable_audio=False):
+                             repair_audio_timestamps=False, disable_audio=False, media_info=None, slot=None,
+                             profile=None):
+        if media_info is None:
+            media_info = self.probe_media(src_file)
         input_options = self.build_input_options(src_file, force_ts_demux)
-        audio_layout = self.detect_audio_layout(src_file.as_posix())
-        has_video = self.has_video_stream(src_file.as_posix())
+        has_video = self.has_video_stream(media_info)
         command = ['ffmpeg', self.overwrite_flag, '-report']
         command.extend(input_options)
         command.extend(['-i', src_file, '-sn', '-dn'])
@@ -156,14 +247,19 @@ class H265Converter:
             command.extend(['-an'])
         else:
             command.extend(['-map', '0:a:0?'])
-        if has_video:
-            command.extend(['-c:v', 'libx265', '-pix_fmt', 'yuv420p'])
-        if not disable_audio:
-            command.extend(['-c:a', 'aac'])
-            if repair_audio_timestamps:
-                command.extend(['-af', 'aresample=async=1:first_pts=0', '-ar', '48000'])
-            if audio_layout is not None:
-                command.extend(['-channel_layout', audio_layout])
+        copy_video = has_video and self.can_copy_video(media_info)
+        if copy_video:
+            command.extend(['-c:v', 'copy'])
+        elif has_video:
+            if profile is None:
+                profile = self.profile_for(src_file, media_info)
+            command.extend(self.build_video_options(media_info, slot, profile))
+        if disable_audio:
+            pass
+        elif copy_video and not repair_audio_timestamps and self.can_copy_audio(media_info):
+            command.extend(['-c:a', 'copy'])
+        else:
+            command.extend(self.build_audio_options(media_info, repair_audio_timestamps))
         command.extend(['-avoid_negative_ts', 'make_zero', '-tag:v', 'hvc1', tmp_file])
         return command
 
@@ -172,9 +268,11 @@ class H265Converter:
         Use more tolerant demux/decode options for transport streams so corruption
         does not cause ffmpeg to abort too early.
         """
-        ts_suffixes = {'.ts', '.m2ts'}
-        if src_file.suffix.lower() not in ts_suffixes:
+        if not self.is_transport_stream(src_file):
             return []
+        return self.transport_stream_input_options(force_ts_demux)
+
+    def transport_stream_input_options(self, force_ts_demux=False):
         input_options = [
             '-fflags', '+genpts+discardcorrupt',
             '-err_detect', 'ignore_err',
@@ -190,98 +288,48 @@ class H265Converter:
     def is_transport_stream(self, src_file):
         return src_file.suffix.lower() in {'.ts', '.m2ts'}
 
-    def is_unreadable_transport_stream(self, log_file):
-        if log_file is None or not log_file.exists():
-            return False
-        try:
-            report = log_file.read_text(errors='ignore')
-        except OSError:
-            return False
-
-        unreadable_markers = [
-            'Error opening input file',
-            'Error opening input files:',
-            'could not find codec parameters',
-            'Could not detect TS packet size',
-            'Invalid data found when processing input'
-        ]
-        for marker in unreadable_markers:
-            if marker in report:
-                return True
-        return False
-
-    def is_unreadable_input(self, log_file):
-        if log_file is None or not log_file.exists():
-            return False
-        try:
-            report = log_file.read_text(errors='ignore')
-        except OSError:
-            return False
-
-        unreadable_markers = [
-            'Error opening input file',
-            'Error opening input files:',
-            'Invalid data found when processing input',
-            'moov atom not found',
-            'could not find codec parameters',
-            'Could not detect TS packet size',
-            'End of file'
-        ]
-        for marker in unreadable_markers:
-            if marker in report:
-                return True
-        return False
-
-    def is_mp4_mux_timestamp_error(self, log_file):
-        if log_file is None or not log_file.exists():
-            return False
-        try:
-            report = log_file.read_text(errors='ignore')
-        except OSError:
-            return False
-
-        markers = [
-            'pts/dts pair unsupported',
-            'Error muxing a packet',
-            'Not yet implemented in FFmpeg, patches welcome'
-        ]
-        for marker in markers:
-            if marker in report:
-                return True
-        return False
+    def diagnose(self, output, log_file):
+        """
+        Classify a failed ffmpeg run from its report.
+        :return: A failureClassifier.Diagnosis; it is empty if the run succeeded.
+        """
+        if output.returncode == 0:
+            return failureClassifier.Diagnosis(log_file)
+        diagnosis = self.failure_classifier.classify(log_file)
+        self.log(f'{datetime.datetime.now()}: ffmpeg exited with {output.returncode}: {diagnosis.summary()}.')
+        return diagnosis
 
     def build_salvage_name(self, video):
-        time_str = strftime('%Y%m%d%H%M%S', localtime())
+        time_str = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
         base_name = video.stem.replace(" ", "")
         return f".{base_name}{time_str}.salvage.ts"
 
-    def try_salvage_remux(self, src_file, tmp_path):
-        salvage_file = tmp_path.joinpath(self.build_salvage_name(src_file))
-        print(f'{datetime.datetime.now()}: Initial encode failed; attempting salvage remux to {salvage_file}...')
-        salvage_file.unlink(missing_ok=True)
+    def build_salvage_command(self, src_file, salvage_output, force_ts_demux=False):
+        """
+        A remux of the first video and audio streams to MPEG-TS, which gets past much of the damage
+        that stops an encode.
+        """
         salvage_command = ['ffmpeg', self.overwrite_flag, '-report']
-        salvage_command.extend(self.build_input_options(src_file))
+        salvage_command.extend(self.build_input_options(src_file, force_ts_demux))
         salvage_command.extend([
             '-i', src_file,
             '-map', '0:v:0?',
             '-map', '0:a:0?',
             '-c', 'copy',
             '-f', 'mpegts',
-            salvage_file
+            salvage_output
         ])
+        return salvage_command
+
+    def try_salvage_remux(self, src_file, tmp_path):
+        salvage_file = tmp_path.joinpath(self.build_salvage_name(src_file))
+        self.log(f'{datetime.datetime.now()}: Initial encode failed; attempting salvage remux to {salvage_file}...')
+        salvage_file.unlink(missing_ok=True)
+        salvage_command = self.build_salvage_command(src_file, salvage_file)
         output, log_file = self.run_ffmpeg(salvage_command, tmp_path, 'salvage')
-        if output.returncode != 0 and src_file.suffix.lower() in {'.ts', '.m2ts'}:
+        if output.returncode != 0 and self.is_transport_stream(src_file):
             salvage_file.unlink(missing_ok=True)
-            salvage_command = ['ffmpeg', self.overwrite_flag, '-report']
-            salvage_command.extend(self.build_input_options(src_file, force_ts_demux=True))
-            salvage_command.extend([
-                '-i', src_file,
-                '-map', '0:v:0?',
-                '-map', '0:a:0?',
-                '-c', 'copy',
-                '-f', 'mpegts',
-                salvage_file
-            ])
+            salvage_command = self.build_salvage_command(src_file, salvage_file, force_ts_demux=True)
             output, log_file = self.run_ffmpeg(salvage_command, tmp_path, 'salvage-tsdemux')
         if output.returncode != 0:
             salvage_file.unlink(missing_ok=True)
@@ -291,8 +339,88 @@ class H265Converter:
             return None, log_file
         return salvage_file, log_file
 
+    def stream_salvage(self, src_file, tmp_file, tmp_path, media_info, slot=None, guard=None,
+                       repair_audio_timestamps=False):
+        """
+        The salvage remux without the intermediate file: the remux writes MPEG-TS to a pipe that the
+        encoder reads, so the source is read once and nothing is written but the output. For a
+        transport stream, a failed remux is tried again with forced TS demux, as try_salvage_remux does.
+        :return: (output, log_file, diagnosis) from the last attempt. If the remux failed, they are
+                 the remux's, since the encoder only saw part of the source.
+        """
+        attempts = [False, True] if self.is_transport_stream(src_file) else [False]
+        duration = media_info.duration if media_info is not None else None
+        for force_ts_demux in attempts:
+            # Named as an encode, so the size guard and encode metrics cover it.
+            phase = 'encode-salvage-stream-tsdemux' if force_ts_demux else 'encode-salvage-stream'
+            if repair_audio_timestamps:
+                phase += '-audio-repair'
+            tmp_file.unlink(missing_ok=True)
+            self.log(f'{datetime.datetime.now()}: Retrying encode from a salvage remux piped into the encoder...')
+            remux_log, remux_env = self.report_env(tmp_path, f'{phase}-remux')
+            remux_command = self.build_salvage_command(src_file, 'pipe:1', force_ts_demux)
+            remux_command.insert(1, '-nostats')
+            encode_command = self.build_encode_command(src_file, tmp_file, media_info=media_info, slot=slot,
+                                                       repair_audio_timestamps=repair_audio_timestamps)
+            input_index = encode_command.index('-i')
+            encode_command = (encode_command[:3] + self.transport_stream_input_options(force_ts_demux=True) +
+                              ['-i', 'pipe:0'] + encode_command[input_index + 2:])
+            remux = subprocess.Popen(remux_command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=remux_env)
+            try:
+                output, log_file = self.run_ffmpeg(encode_command, tmp_path, phase, slot, duration, guard,
+                                                   stdin=remux.stdout)
+            finally:
+                try:
+                    remux.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    remux.kill()
+                    remux.wait()
+            if remux.returncode == 0:
+                return output, log_file, self.diagnose(output, log_file)
+            remux_diagnosis = self.failure_classifier.classify(remux_log)
+            if output.returncode != 0 and (remux.returncode == -signal.SIGPIPE or remux_diagnosis.broken_pipe):
+                # The encoder failed first and the remux died writing to the closed pipe; trying the remux
+                # again won't help.
+                return output, log_file, self.diagnose(output, log_file)
+            # The encoder saw part of the source or none of it, so only the remux's report says what is wrong.
+            tmp_file.unlink(missing_ok=True)
+            output = subprocess.CompletedProcess(remux_command, remux.returncode)
+            log_file = remux_log
+            diagnosis = self.diagnose(output, log_file)
+            if diagnosis.mux_timestamp_error:
+                return output, log_file, diagnosis
+        return output, log_file, diagnosis
+
+    def set_job_label(self, label):
+        """
+        Tag everything logged from the calling thread with label, so output from concurrent jobs
+        can be told apart. None clears it.
+        """
+        self.job_local.label = label
+
+    def job_label(self):
+        return getattr(self.job_local, 'label', None)
+
+    def job_encode_seconds(self):
+        """
+        Wall time of the last encode on the calling thread, without time spent choosing its CRF, or
+        None if convert_video didn't get as far as encoding.
+        """
+        return getattr(self.job_local, 'encode_seconds', None)
+
+    def job_prefix(self):
+        label = self.job_label()
+        if label is None:
+            return ''
+        return f'[{label}] '
+
+    def log(self, *args, **kwargs):
+        message = ' '.join(str(arg) for arg in args)
+        print(f'{self.job_prefix()}{message}', **kwargs)
+
     def eprint(self, *args, **kwargs):
-        print(*args, file=sys.stderr, **kwargs)
+        message = ' '.join(str(arg) for arg in args)
+        print(f'{self.job_prefix()}{message}', file=sys.stderr, **kwargs)
 
     def error_stop(self, *args, **kwargs):
         self.eprint(*args, **kwargs)
@@ -317,12 +445,15 @@ class H265Converter:
         return f'{num:.3f} {unit}'
 
     def tmp_name(self, video):
+        """
+        The name to encode into. Without a tmp_dir it is written next to the destination, so it is
+        marked as a partial file; either way it ends in the suffix, so scans don't pick it up.
+        """
+        time_str = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+        base_name = video.stem.replace(" ", "")
         if self.tmp_dir:
-            time_str = strftime('%Y%m%d%H%M%S', localtime())
-            base_name = video.stem.replace(" ", "")
-            tmp_name = f".{base_name}{time_str}{self.suffix}"
-            return tmp_name
-        return video.name
+            return f".{base_name}{time_str}{self.suffix}"
+        return f".{base_name}{time_str}.part{self.suffix}"
 
     def new_video_name(self, video, dest_path):
         """
@@ -344,46 +475,146 @@ class H265Converter:
         name = Path(name).with_suffix(self.suffix)
         return dest_path.joinpath(name)
 
-    def print_quantity_with_tag(self, quant, singular, plural):
-        print(f'{quant}', end="")
+    def quantity_with_tag(self, quant, singular, plural):
         if quant == 1:
-            print(f' {singular}', end="")
-        else:
-            print(f' {plural}', end="")
+            return f'{quant} {singular}'
+        return f'{quant} {plural}'
 
-    def pretty_print_duration(self, duration):
+    def duration_string(self, duration):
         if round(duration.seconds) == 0:
-            print('0 seconds')
-            return
+            return '0 seconds'
 
+        parts = []
         hours = int(duration.seconds / 3600)
         if hours > 0:
-            self.print_quantity_with_tag(hours, "hour", "hours")
+            parts.append(self.quantity_with_tag(hours, "hour", "hours"))
             duration -= datetime.timedelta(seconds=hours*3600)
-            seconds = int(round(duration.seconds))
-            if seconds > 0:
-                print(', ', end="")
 
         minutes = int(duration.seconds / 60)
         if minutes > 0:
-            self.print_quantity_with_tag(minutes, "minute", "minutes")
+            parts.append(self.quantity_with_tag(minutes, "minute", "minutes"))
             duration -= datetime.timedelta(seconds=minutes*60)
 
         seconds = int(round(duration.seconds))
-        if (hours > 0) or (minutes > 0):
-            if seconds > 0:
-                print(', ', end="")
-                self.print_quantity_with_tag(seconds, "second", "seconds")
-        else:
-            self.print_quantity_with_tag(seconds, "second", "seconds")
+        if seconds > 0 or len(parts) == 0:
+            parts.append(self.quantity_with_tag(seconds, "second", "seconds"))
 
-        print('')
+        return ', '.join(parts)
 
-    def convert_video(self, src, dest=None):
+    def pretty_print_duration(self, duration):
+        self.log(self.duration_string(duration))
+
+    def size_guard(self, media_info, src_size):
+        """
+        :return: A SizeGuard that stops encodes whose output won't be at least min_savings percent
+                 smaller than the source, or None if there is no minimum or the duration is unknown.
+        """
+        if self.min_savings is None or media_info is None or not media_info.duration:
+            return None
+        return encodeProgress.SizeGuard(src_size * (1 - self.min_savings / 100) / media_info.duration)
+
+    def encode_with_retries(self, src_file, tmp_file, tmp_path, src_size, media_info, command, slot=None,
+                            dest_file=None, guard=None, source_file=None):
+        """
+        Run the encode, then work down the retry ladder: forced TS demux, salvage remux, and audio
+        timestamp repair. In the 'stream' salvage mode the remux is piped into the encoder; in the
+        'file' mode it is written to tmp_path first. Each failed attempt's report is classified once,
+        and the diagnosis decides which rung comes next. Every attempt is checked against guard.
+        :return: (output, log_file, salvage_file, diagnosis) from the last attempt; salvage_file is None
+                 if no salvage remux file was made.
+        :param source_file: The library file being converted, when src_file is a staged copy of it. Segment
+                            work is kept under its name, so it can be resumed whether or not a copy is staged.
+        """
+        if source_file is None:
+            source_file = src_file
+        salvage_file = None
+        duration = media_info.duration if media_info is not None else None
+        copy_video = self.can_copy_video(media_info)
+        if copy_video:
+            # A remux is quick and the output is no smaller; neither segments nor the size guard apply.
+            guard = None
+            self.log(f'{datetime.datetime.now()}: Source is already HEVC at {media_info.video_bit_rate} bit/s; '
+                     f'copying the video stream.')
+        try:
+            if copy_video:
+                output, log_file = self.run_ffmpeg(command, tmp_path, 'remux', None, duration)
+            elif self.segmented_encoder.should_segment(src_size, media_info):
+                output, log_file = self.segmented_encoder.encode(source_file, tmp_file, tmp_path, media_info, slot,
+                                                                 dest_file, guard, src_file)
+                if output.returncode != 0:
+                    self.log(f'{datetime.datetime.now()}: Segmented encode failed; falling back to a single encode...')
+                    metricsExporter.retries.inc(label='encode')
+                    self.segmented_encoder.discard(source_file, tmp_path)
+                    tmp_file.unlink(missing_ok=True)
+                    output, log_file = self.run_ffmpeg(command, tmp_path, 'encode', slot, duration, guard)
+            else:
+                output, log_file = self.run_ffmpeg(command, tmp_path, 'encode', slot, duration, guard)
+            diagnosis = self.diagnose(output, log_file)
+            if output.returncode != 0 and self.is_transport_stream(src_file):
+                tmp_file.unlink(missing_ok=True)
+                metricsExporter.retries.inc(label='tsdemux')
+                command = self.build_encode_command(src_file, tmp_file, force_ts_demux=True,
+                                                    media_info=media_info, slot=slot)
+                output, log_file = self.run_ffmpeg(command, tmp_path, 'encode-tsdemux', slot, duration, guard)
+                diagnosis = self.diagnose(output, log_file)
+            salvage_info = None
+            streamed = False
+            if output.returncode != 0 and diagnosis.salvageable and self.salvage_mode == 'stream':
+                metricsExporter.retries.inc(label='salvage')
+                streamed = True
+                output, log_file, diagnosis = self.stream_salvage(src_file, tmp_file, tmp_path, media_info, slot,
+                                                                  guard)
+            elif output.returncode != 0 and diagnosis.salvageable:
+                metricsExporter.retries.inc(label='salvage')
+                salvage_file, log_file = self.try_salvage_remux(src_file, tmp_path)
+                if salvage_file is None:
+                    diagnosis = self.failure_classifier.classify(log_file)
+                else:
+                    tmp_file.unlink(missing_ok=True)
+                    salvage_info = self.probe_media(salvage_file, use_cache=False)
+                    # The salvage file is encoded with the source's profile, including any searched CRF.
+                    profile = self.profile_for(src_file, media_info)
+                    salvage_command = self.build_encode_command(salvage_file, tmp_file, media_info=salvage_info,
+                                                                slot=slot, profile=profile)
+                    self.log(f'{datetime.datetime.now()}: Retrying encode from salvage remux...')
+                    output, log_file = self.run_ffmpeg(salvage_command, tmp_path, 'encode-salvage', slot,
+                                                       salvage_info.duration, guard)
+                    diagnosis = self.diagnose(output, log_file)
+            if output.returncode != 0 and diagnosis.mux_timestamp_error and streamed:
+                self.log(f'{datetime.datetime.now()}: Retrying encode with audio timestamp repair...')
+                metricsExporter.retries.inc(label='audio-repair')
+                output, log_file, diagnosis = self.stream_salvage(src_file, tmp_file, tmp_path, media_info, slot,
+                                                                  guard, repair_audio_timestamps=True)
+            elif output.returncode != 0 and diagnosis.mux_timestamp_error:
+                retry_src = salvage_file if salvage_file is not None else src_file
+                retry_info = salvage_info if salvage_file is not None else media_info
+                tmp_file.unlink(missing_ok=True)
+                self.log(f'{datetime.datetime.now()}: Retrying encode with audio timestamp repair...')
+                metricsExporter.retries.inc(label='audio-repair')
+                repair_command = self.build_encode_command(
+                    retry_src, tmp_file,
+                    force_ts_demux=self.is_transport_stream(retry_src),
+                    repair_audio_timestamps=True,
+                    media_info=retry_info,
+                    slot=slot,
+                    profile=self.profile_for(src_file, media_info)
+                )
+                output, log_file = self.run_ffmpeg(repair_command, tmp_path, 'encode-audio-repair', slot,
+                                                   retry_info.duration if retry_info is not None else None, guard)
+                diagnosis = self.diagnose(output, log_file)
+        except (encodeController.EncodeInterrupted, encodeProgress.EncodeAbandoned):
+            if salvage_file is not None:
+                salvage_file.unlink(missing_ok=True)
+            raise
+        return output, log_file, salvage_file, diagnosis
+
+    def convert_video(self, src, dest=None, slot=None, staged=None):
         """
         Encodes video to h265.
         :param src: Path to source file
         :param dest: If given, path to destination file; otherwise, this is computed and done in place
+        :param slot: If given, the EncodeSlot that bounds the encoder's threads and CPUs
+        :param staged: If given, a local copy of src for the encoder to read instead
         :return: None
         """
 
@@ -395,9 +626,10 @@ class H265Converter:
         # tmp_file - PosixPath to in-progress encoding
         # dest_file - PosixPath to final file.
 
+        self.job_local.encode_seconds = None
         src_file = Path(src)
         if str(src_file).lower().endswith('.h265.mp4'):
-            print(f'{datetime.datetime.now()}: Skipping prior converted file {src_file}.')
+            self.log(f'{datetime.datetime.now()}: Skipping prior converted file {src_file}.')
             return True
 
         if not src_file.exists():
@@ -405,18 +637,18 @@ class H265Converter:
             return False
 
         src_size = src_file.stat().st_size
-        print(f'Source = {src_file} - {self.size_string(src_size)}')
+        self.log(f'Source = {src_file} - {self.size_string(src_size)}')
 
         src_path = src_file.parent
 
         if dest is None:
             dest_path = src_path
-            dest_file = dest_path.joinpath(dest)
+            dest_file = self.new_video_name(src_file, dest_path)
         else:
             dest_file = Path(dest)
             dest_path = dest_file.parent
 
-        if not dest_path.exists():
+        if not dest_path.exists() and not self.dry_run:
             self.error_output('Dest Path ' + str(dest_path) + ' does not exist.')
             return False
 
@@ -427,90 +659,218 @@ class H265Converter:
 
         tmp_file_name = self.tmp_name(src_file)
         tmp_file = tmp_path.joinpath(tmp_file_name)
-        print(f'Temp = {tmp_file}')
+        self.log(f'Temp = {tmp_file}')
 
-        print(f'Dest = {dest_file}')
+        self.log(f'Dest = {dest_file}')
 
         if self.overwrite_flag == '-n' and dest_file.exists():
-            print(f'{datetime.datetime.now()}: {dest_file} exists.')
+            self.log(f'{datetime.datetime.now()}: {dest_file} exists.')
             if not self.dry_run and not self.preserve_source:
                 src_file.unlink()
             return True
 
-        command = self.build_encode_command(src_file, tmp_file)
+        media_info = self.probe_media(src_file)
+        self.job_local.profile = None
+        if self.profiles.enabled and not self.can_copy_video(media_info):
+            self.job_local.profile = self.profiles.choose(media_info)
+            self.log(f'Profile = {self.job_local.profile}')
+        if self.crf_search.enabled and not self.dry_run and not self.can_copy_video(media_info):
+            profile = self.job_local.profile or encodeProfiles.Profile()
+            tmp_path.mkdir(parents=True, exist_ok=True)
+            crf = self.crf_search.choose(src_file, tmp_path, media_info, profile, slot)
+            if crf is not None:
+                profile.crf = crf
+                self.job_local.profile = profile
+        input_file = src_file if staged is None else Path(staged)
+        if staged is not None:
+            self.log(f'Reading from staged copy {input_file}')
+        with self.profiles_lock:
+            self.source_profiles[str(src_file)] = self.job_local.profile
+            self.source_profiles[str(input_file)] = self.job_local.profile
+        try:
+            return self.convert_with_profile(src_file, input_file, src_size, dest_file, dest_path, tmp_path,
+                                             tmp_file, media_info, slot)
+        finally:
+            with self.profiles_lock:
+                self.source_profiles.pop(str(src_file), None)
+                self.source_profiles.pop(str(input_file), None)
+
+    def convert_with_profile(self, src_file, input_file, src_size, dest_file, dest_path, tmp_path, tmp_file,
+                             media_info, slot):
+        """
+        The rest of convert_video, once the encoding profile for the source has been chosen. The
+        encoder reads input_file, which is src_file or a staged copy of it.
+        """
+        command = self.build_encode_command(input_file, tmp_file, media_info=media_info, slot=slot)
 
         if not self.dry_run:
             start = datetime.datetime.now()
 
             tmp_path.mkdir(parents=True, exist_ok=True)
 
-            print(f'{start}: Converting {src_file} to {tmp_file}...')
-            output, log_file = self.run_ffmpeg(command, tmp_path, 'encode')
-            if output.returncode != 0 and self.is_transport_stream(src_file):
+            self.log(f'{start}: Converting {src_file} to {tmp_file}...')
+            guard = self.size_guard(media_info, src_size)
+            try:
+                output, log_file, salvage_file, diagnosis = self.encode_with_retries(
+                    input_file, tmp_file, tmp_path, src_size, media_info, command, slot, dest_file, guard, src_file)
+            except encodeController.EncodeInterrupted:
                 tmp_file.unlink(missing_ok=True)
-                command = self.build_encode_command(src_file, tmp_file, force_ts_demux=True)
-                output, log_file = self.run_ffmpeg(command, tmp_path, 'encode-tsdemux')
-            salvage_file = None
-            if output.returncode != 0 and not self.is_unreadable_input(log_file):
-                salvage_file, log_file = self.try_salvage_remux(src_file, tmp_path)
-                if salvage_file is not None:
-                    tmp_file.unlink(missing_ok=True)
-                    salvage_command = self.build_encode_command(salvage_file, tmp_file)
-                    print(f'{datetime.datetime.now()}: Retrying encode from salvage remux...')
-                    output, log_file = self.run_ffmpeg(salvage_command, tmp_path, 'encode-salvage')
-            if output.returncode != 0 and self.is_mp4_mux_timestamp_error(log_file):
-                retry_src = salvage_file if salvage_file is not None else src_file
+                self.log(f'{datetime.datetime.now()}: Stopped converting {src_file}; it will be resumed later.')
+                raise
+            except encodeProgress.EncodeAbandoned:
                 tmp_file.unlink(missing_ok=True)
-                print(f'{datetime.datetime.now()}: Retrying encode with audio timestamp repair...')
-                repair_command = self.build_encode_command(
-                    retry_src, tmp_file,
-                    force_ts_demux=self.is_transport_stream(retry_src),
-                    repair_audio_timestamps=True
-                )
-                output, log_file = self.run_ffmpeg(repair_command, tmp_path, 'encode-audio-repair')
+                self.segmented_encoder.discard(src_file, tmp_path)
+                projected_size = int(guard.projected_rate * media_info.duration)
+                self.log(f'{datetime.datetime.now()}: Abandoned converting {src_file}; the output was headed for '
+                         f'{self.size_string(projected_size)}, which would save less than {self.min_savings}%.')
+                if self.probe_cache is not None:
+                    src_stat = src_file.stat()
+                    self.probe_cache.mark_unprofitable(src_file, src_stat.st_size, src_stat.st_mtime, projected_size)
+                raise
             end = datetime.datetime.now()
             duration = end - start
+            self.job_local.encode_seconds = duration.total_seconds()
 
             if output.returncode == 0:
                 if (not tmp_file.exists()) or tmp_file.stat().st_size == 0:
                     self.error_output(f'{end}: Problem converting {src_file} to {tmp_file}; output file is empty.')
+                    tmp_file.unlink(missing_ok=True)
                     if self.tmp_dir is not None:
-                        tmp_file.unlink(missing_ok=True)
                         backup_logfile = tmp_file.parent.joinpath(src_file.name).with_suffix('.err')
                         shutil.copyfile(log_file.as_posix(), backup_logfile)
                     if salvage_file is not None:
                         salvage_file.unlink(missing_ok=True)
                     return False
                 dest_path.mkdir(parents=True, exist_ok=True)
-                print(f'{end}: Wrote {self.size_string(tmp_file.stat().st_size)}.')
-                if self.tmp_dir:
-                    print(f"{datetime.datetime.now()}: Moving {tmp_file} to {dest_file}.")
-                    shutil.move(tmp_file.as_posix(), dest_file.as_posix())
-                if not self.preserve_source:
-                    src_file.unlink()
+                output_size = tmp_file.stat().st_size
+                self.log(f'{end}: Wrote {self.size_string(output_size)}.')
                 if salvage_file is not None:
                     salvage_file.unlink(missing_ok=True)
+                on_done = lambda moved: self.finish_conversion(src_file, src_size, dest_file, output_size, moved)
+                # Without a tmp_dir, tmp_file is next to dest_file and this is a rename.
+                self.mover.finalize(tmp_file, dest_file, src_file, on_done, self.log)
             else:
                 self.error_output(f'{end}: Problem converting {src_file} to {tmp_file}')
+                tmp_file.unlink(missing_ok=True)
                 if self.tmp_dir is not None:
-                    tmp_file.unlink(missing_ok=True)
                     backup_logfile = tmp_file.parent.joinpath(src_file.name).with_suffix('.err')
                     shutil.copyfile(log_file.as_posix(), backup_logfile)
-                if self.is_transport_stream(src_file) and self.is_unreadable_transport_stream(log_file):
-                    print(f'{datetime.datetime.now()}: Removing unreadable transport stream {src_file}.')
+                if self.is_transport_stream(src_file) and diagnosis.unreadable_transport_stream:
+                    self.log(f'{datetime.datetime.now()}: Removing unreadable transport stream {src_file}.')
                     src_file.unlink(missing_ok=True)
                 if salvage_file is not None:
                     salvage_file.unlink(missing_ok=True)
                 return False
-            print(f"{datetime.datetime.now()}: Time: ", end="")
-            self.pretty_print_duration(duration)
+            self.log(f"{datetime.datetime.now()}: Time: {self.duration_string(duration)}")
 
         return True
 
-    def convert_videos(self, files, dest=None):
-        for file in files:
-            print(f'{datetime.datetime.now()}: Converting {file}...')
-
-            self.convert_video(file, dest)
+    def finish_conversion(self, src_file, src_size, dest_file, output_size, moved):
+        """
+        Called once the converted file is at its destination, which may be after a background move.
+        """
+        if not moved:
+            self.failed_moves.add(str(src_file))
+            metricsExporter.failed.inc()
+            return
+        if self.destination_index is not None:
+            self.destination_index.add(dest_file)
+        self.progress.record_converted(src_size)
+        metricsExporter.converted.inc()
+        metricsExporter.bytes_saved.inc(max(src_size - output_size, 0))
+        if not self.preserve_source:
+            src_file.unlink(missing_ok=True)
+
+    def batch_destinations(self, files, dest=None):
+        """
+        Work out where each file of a batch goes. Directories are searched recursively for files
+        with a video suffix, skipping what the library tool skips.
+
+        Without dest, files are converted where they are. If dest is an existing directory, ends
+        with a slash, or there is more than one source or any directory among them, outputs go
+        into dest, and each source directory becomes a directory of the same name there with its
+        tree recreated. Otherwise dest names the single output file, with '.mp4' appended if it
+        doesn't end in it.
+        :return: A list of (source Path, destination file Path).
+        """
+        sources = [Path(file) for file in files]
+        dest_is_directory = dest is not None and (len(sources) > 1 or str(dest).endswith('/') or Path(dest).is_dir()
+                                                  or any(source.is_dir() for source in sources))
+        candidates = candidateFilter.CandidateFilter(self.suffix, self.video_suffixes)
+        pairs = []
+        for source in sources:
+            if source.is_dir():
+                dest_root = source if dest is None else Path(dest).joinpath(source.resolve().name)
+                for top, directories, names in os.walk(source):
+                    directories[:] = sorted(directory for directory in directories
+                                            if directory not in candidates.skip_directories)
+                    dest_path = dest_root.joinpath(Path(top).relative_to(source))
+                    for name in sorted(names):
+                        src_file = Path(top, name)
+                        if not name.startswith('.') and candidates.want(src_file):
+                            pairs.append((src_file, self.new_video_name(src_file, dest_path)))
+            elif dest is None:
+                pairs.append((source, self.new_video_name(source, source.parent)))
+            elif dest_is_directory:
+                pairs.append((source, self.new_video_name(source, Path(dest))))
+            else:
+                dest_file = Path(dest)
+                if dest_file.suffix != '.mp4':
+                    dest_file = dest_file.with_name(f'{dest_file.name}.mp4')
+                pairs.append((source, dest_file))
+        return pairs
 
-        print('{datetime.datetime.now()}: Done.')
+    def convert_batch_file(self, src_file, dest_file, label, stopping):
+        """
+        Convert one file of a batch.
+        :return: 'converted', 'failed', 'abandoned', or 'skipped' if the batch was stopped first.
+        """
+        if stopping.is_set():
+            return 'skipped'
+        self.set_job_label(label)
+        self.log(f'{datetime.datetime.now()}: Converting {src_file}...')
+        try:
+            if not self.dry_run:
+                dest_file.parent.mkdir(parents=True, exist_ok=True)
+            return 'converted' if self.convert_video(str(src_file), dest_file) else 'failed'
+        except encodeProgress.EncodeAbandoned:
+            return 'abandoned'
+        except (OSError, SystemExit) as e:
+            if isinstance(e, OSError):
+                self.eprint(f'{datetime.datetime.now()}: Could not convert {src_file}: {e}')
+            if self.error_output == self.error_stop:
+                # Without --continue, the first error ends the batch once the running jobs finish.
+                stopping.set()
+            return 'failed'
+        finally:
+            self.set_job_label(None)
+
+    def convert_videos(self, files, dest=None, jobs=1):
+        """
+        Convert a batch of files and directories, jobs at a time, and print what happened to each.
+        See batch_destinations for where the outputs go. Without a probe cache, the batch gets one
+        of its own for its duration.
+        :return: True if no file failed.
+        """
+        if self.probe_cache is None:
+            self.probe_cache = probeCache.ProbeCache()
+        pairs = self.batch_destinations(files, dest)
+        stopping = threading.Event()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='convert') as executor:
+            futures = [executor.submit(self.convert_batch_file, src_file, dest_file,
+                                       f'{index}/{len(pairs)}' if jobs > 1 else None, stopping)
+                       for index, (src_file, dest_file) in enumerate(pairs, 1)]
+        self.mover.wait()
+
+        counts = {}
+        print(f'{datetime.datetime.now()}: Done.')
+        for (src_file, dest_file), future in zip(pairs, futures):
+            result = future.result()
+            if result == 'converted' and str(src_file) in self.failed_moves:
+                result = 'failed'
+            elif result == 'converted' and not self.dry_run and not dest_file.exists():
+                result = 'failed'
+            counts[result] = counts.get(result, 0) + 1
+            print(f'{result:>10}: {src_file} -> {dest_file}')
+        print(', '.join(f'{count} {result}' for result, count in sorted(counts.items())) or 'No files to convert.')
+        return counts.get('failed', 0) == 0 and counts.get('skipped', 0) == 0
@@ -0,0 +1,217 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """
+    Reports files under a root that were closed after writing or moved in, using inotify.
+    Every directory gets its own watch; new directories are picked up as they appear.
+    """
+
+    root = None
+    skip_directories = []
+    libc = None
+    fd = None
+    watches = {}
+    inodes = {}
+    overflowed = False
+
+    def __init__(self, root, skip_directories=()):
+        self.root = os.fspath(root)
+        self.skip_directories = skip_directories
+        self.watches = {}
+        self.inodes = {}
+        library = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        try:
+            self.watch_tree(self.root)
+        except OSError:
+            # Typically ENOSPC from running out of watches on a large tree; the caller falls back to polling.
+            self.close()
+            raise
+
+    def watch_directory(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return
+            raise OSError(error, f'inotify_add_watch {path}: {os.strerror(error)}')
+        self.watches[wd] = path
+        try:
+            stat_result = os.stat(path)
+            self.inodes[wd] = (stat_result.st_dev, stat_result.st_ino)
+        except OSError:
+            self.inodes.pop(wd, None)
+
+    def watch_tree(self, top):
+        """
+        Watch top and every directory under it.
+        :return: The files already present, which were written before the watches existed.
+        """
+        existing = []
+        for directory, dirs, files in os.walk(top):
+            dirs[:] = [name for name in dirs if name not in self.skip_directories]
+            self.watch_directory(directory)
+            existing.extend(os.path.join(directory, name) for name in files)
+        return existing
+
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds for events.
+        :return: A list of file paths that were written or moved in. After an event queue overflow,
+                 overflowed is set and the caller should rescan.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return []
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        changed = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                self.inodes.pop(wd, None)
+                continue
+            if mask & IN_MOVE_SELF:
+                self.moved(wd)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or len(name) == 0:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and os.path.basename(path) not in self.skip_directories:
+                    changed.extend(self.watch_tree(path))
+                continue
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changed.append(path)
+        return changed
+
+    def moved(self, wd):
+        """
+        A watched directory was renamed. If it moved within the tree, the IN_MOVED_TO in its new
+        parent has already pointed the watch at its new path; otherwise the entries for it and the
+        directories under it are stale, and those watches are dropped.
+        """
+        path = self.watches.get(wd)
+        if path is None:
+            return
+        try:
+            stat_result = os.stat(path)
+            if (stat_result.st_dev, stat_result.st_ino) == self.inodes.get(wd):
+                return
+        except OSError:
+            pass
+        prefix = os.path.join(path, '')
+        for stale in [key for key, value in self.watches.items() if value == path or value.startswith(prefix)]:
+            self.watches.pop(stale, None)
+            self.inodes.pop(stale, None)
+            self.libc.inotify_rm_watch(self.fd, stale)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class PollingWatcher:
+    """
+    Fallback for platforms without inotify. Re-scans the file index every interval and reports
+    files that are new or whose size or mtime changed.
+    """
+
+    file_index = None
+    root = None
+    skip_directories = []
+    want = None
+    interval = 300
+    next_poll = 0
+    known = {}
+    overflowed = False
+
+    def __init__(self, file_index, root, skip_directories=(), want=None, interval=300):
+        self.file_index = file_index
+        self.root = os.fspath(root)
+        self.skip_directories = skip_directories
+        self.want = want
+        self.interval = interval
+        self.known = self.snapshot()
+        self.next_poll = time.monotonic() + interval
+
+    def snapshot(self):
+        files = {}
+        for top, name, size, mtime in self.file_index.scan(self.root, self.skip_directories, self.want):
+            files[os.path.join(top, name)] = (size, mtime)
+        return files
+
+    def poll(self, timeout):
+        remaining = self.next_poll - time.monotonic()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(remaining, 0))
+        self.next_poll = time.monotonic() + self.interval
+        current = self.snapshot()
+        changed = [path for path, state in current.items() if self.known.get(path) != state]
+        self.known = current
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(file_index, root, skip_directories=(), want=None, poll_interval=300):
+    """
+    Use inotify where it is available, falling back to polling the file index.
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root, skip_directories)
+        except (OSError, AttributeError) as e:
+            print(f'inotify unavailable ({e}); polling every {poll_interval} seconds instead.', file=sys.stderr)
+    return PollingWatcher(file_index, root, skip_directories, want, poll_interval)
@@ -0,0 +1,221 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import json
+import subprocess
+import time
+
+from pathlib import Path
+
+import metricsExporter
+
+
+def parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_rate(value):
+    """
+    Convert an ffprobe rational such as '30000/1001' to frames per second.
+    """
+    if not value:
+        return None
+    if '/' not in value:
+        return parse_float(value)
+    num, den = value.split('/', 1)
+    num = parse_float(num)
+    den = parse_float(den)
+    if not num or not den:
+        return None
+    return num / den
+
+
+class StreamInfo:
+
+    index = None
+    codec_type = None
+    codec_name = None
+    channels = None
+    channel_layout = None
+    width = None
+    height = None
+    pix_fmt = None
+    bit_rate = None
+    frame_rate = None
+    duration = None
+
+    def __init__(self, stream):
+        self.index = parse_int(stream.get('index'))
+        self.codec_type = stream.get('codec_type')
+        self.codec_name = stream.get('codec_name')
+        self.channels = parse_int(stream.get('channels'))
+        self.channel_layout = stream.get('channel_layout')
+        self.width = parse_int(stream.get('width'))
+        self.height = parse_int(stream.get('height'))
+        self.pix_fmt = stream.get('pix_fmt')
+        self.bit_rate = parse_int(stream.get('bit_rate'))
+        self.frame_rate = parse_rate(stream.get('avg_frame_rate')) or parse_rate(stream.get('r_frame_rate'))
+        self.duration = parse_float(stream.get('duration'))
+
+    def __repr__(self):
+        return f'StreamInfo({self.index}, {self.codec_type}, {self.codec_name})'
+
+
+class MediaInfo:
+    """
+    Everything we need to know about a source, parsed from a single
+    'ffprobe -show_streams -show_format' run.
+    """
+
+    streams = []
+    format_name = None
+    duration = None
+    start_time = 0.0
+    bit_rate = None
+    size = None
+    probe_data = None
+
+    def __init__(self, probe_data):
+        self.probe_data = probe_data
+        self.streams = [StreamInfo(stream) for stream in probe_data.get('streams', [])]
+        format_data = probe_data.get('format', {})
+        self.format_name = format_data.get('format_name')
+        self.duration = parse_float(format_data.get('duration'))
+        self.start_time = parse_float(format_data.get('start_time')) or 0.0
+        self.bit_rate = parse_int(format_data.get('bit_rate'))
+        self.size = parse_int(format_data.get('size'))
+
+    @classmethod
+    def from_json(cls, text):
+        """
+        :return: A MediaInfo, or None if the text is not valid ffprobe output.
+        """
+        try:
+            probe_data = json.loads(text)
+        except (json.JSONDecodeError, TypeError):
+            return None
+        if not isinstance(probe_data, dict):
+            return None
+        return cls(probe_data)
+
+    def to_json(self):
+        return json.dumps(self.probe_data)
+
+    def streams_of_type(self, codec_type):
+        return [stream for stream in self.streams if stream.codec_type == codec_type]
+
+    @property
+    def video(self):
+        streams = self.streams_of_type('video')
+        if len(streams) == 0:
+            return None
+        return streams[0]
+
+    @property
+    def audio(self):
+        streams = self.streams_of_type('audio')
+        if len(streams) == 0:
+            return None
+        return streams[0]
+
+    @property
+    def has_video(self):
+        return self.video is not None
+
+    @property
+    def has_audio(self):
+        return self.audio is not None
+
+    @property
+    def video_codec(self):
+        if self.video is None:
+            return None
+        return self.video.codec_name
+
+    @property
+    def channels(self):
+        if self.audio is None:
+            return None
+        return self.audio.channels
+
+    @property
+    def channel_layout(self):
+        if self.audio is None:
+            return None
+        return self.audio.channel_layout
+
+    @property
+    def pix_fmt(self):
+        if self.video is None:
+            return None
+        return self.video.pix_fmt
+
+    @property
+    def width(self):
+        if self.video is None:
+            return None
+        return self.video.width
+
+    @property
+    def height(self):
+        if self.video is None:
+            return None
+        return self.video.height
+
+    @property
+    def video_bit_rate(self):
+        """
+        Stream bit rate when the container reports it, otherwise the overall bit rate.
+        """
+        if self.video is not None and self.video.bit_rate:
+            return self.video.bit_rate
+        return self.bit_rate
+
+    def __repr__(self):
+        return f'MediaInfo({self.format_name}, {self.duration}s, {self.streams})'
+
+
+def run_probe(src_file, force_ts_demux=False):
+    probe_command = ['ffprobe', '-v', 'error']
+    if force_ts_demux:
+        probe_command.extend([
+            '-f', 'mpegts',
+            '-analyzeduration', '100M',
+            '-probesize', '100M'
+        ])
+    probe_command.extend([
+        '-show_streams',
+        '-show_format',
+        '-of', 'json',
+        str(src_file)
+    ])
+    return subprocess.run(probe_command, capture_output=True, text=True)
+
+
+def probe_media(src_file):
+    """
+    Probe a source once. Transport streams that ffprobe can't open on its own are retried with
+    the mpegts demuxer forced.
+    :return: A MediaInfo, or None if the file could not be probed.
+    """
+    start = time.monotonic()
+    result = run_probe(src_file)
+    if result.returncode != 0 and Path(src_file).suffix.lower() in {'.ts', '.m2ts'}:
+        result = run_probe(src_file, force_ts_demux=True)
+    metricsExporter.probe_seconds.observe(time.monotonic() - start)
+    if result.returncode != 0:
+        return None
+    return MediaInfo.from_json(result.stdout)
@@ -0,0 +1,188 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import http.server
+import math
+import threading
+
+
+class Metric:
+    """
+    One metric family in the OpenMetrics text format. Values are kept per label value; metrics
+    without a label use the label value None.
+    """
+
+    kind = None
+    name = None
+    help = None
+    label = None
+    lock = None
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.lock = threading.Lock()
+
+    def labels(self, value, extra=None):
+        pairs = []
+        if self.label is not None and value is not None:
+            pairs.append(f'{self.label}="{escape(value)}"')
+        if extra is not None:
+            pairs.append(extra)
+        if len(pairs) == 0:
+            return ''
+        return '{' + ','.join(pairs) + '}'
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+    def samples(self):
+        raise NotImplementedError
+
+    def exposition(self):
+        return self.header() + self.samples()
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def number(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+    values = {}
+
+    def __init__(self, name, help, label=None):
+        super().__init__(name, help, label)
+        self.values = {}
+
+    def inc(self, amount=1, label=None):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        if len(values) == 0 and self.label is None:
+            values[None] = 0
+        return [f'{self.name}_total{self.labels(label)} {number(value)}' for label, value in sorted(
+            values.items(), key=lambda item: str(item[0]))]
+
+
+class Gauge(Metric):
+    """
+    A gauge whose value is read from function when the metrics are scraped.
+    """
+
+    kind = 'gauge'
+    function = None
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return []
+        return [f'{self.name} {number(self.function())}']
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+    buckets = []
+    counts = []
+    count = 0
+    sum = 0
+
+    def __init__(self, name, help, buckets):
+        super().__init__(name, help)
+        self.buckets = list(buckets) + [math.inf]
+        self.counts = [0] * len(self.buckets)
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            lines = []
+            for bound, count in zip(self.buckets, self.counts):
+                le = 'le="' + number(bound) + '"'
+                lines.append(f'{self.name}_bucket{self.labels(None, le)} {count}')
+            lines.append(f'{self.name}_count {self.count}')
+            lines.append(f'{self.name}_sum {number(self.sum)}')
+        return lines
+
+
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+queue_files = Gauge('video_queue_files', 'Files queued or being converted.')
+queue_bytes = Gauge('video_queue_bytes', 'Bytes of source queued or being converted.')
+converted = Counter('video_converted_files', 'Files converted.')
+failed = Counter('video_failed_files', 'Files that failed to convert and went to the error list.')
+bytes_saved = Counter('video_saved_bytes', 'Source bytes minus output bytes of converted files.')
+encode_fps = Histogram('video_encode_fps', 'Average frames per second of finished encodes.',
+                       [1, 2, 5, 10, 20, 30, 60, 120, 240])
+encode_speed = Histogram('video_encode_speed', 'Average speed of finished encodes, relative to real time.',
+                         [0.1, 0.25, 0.5, 1, 2, 4, 8, 16])
+probe_seconds = Histogram('video_probe_seconds', 'Time taken by ffprobe.', latency_buckets)
+scan_seconds = Histogram('video_scan_seconds', 'Time taken to scan the library for candidates.',
+                         [0.1, 1, 5, 10, 30, 60, 300, 900, 3600])
+window_wait_seconds = Counter('video_window_wait_seconds', 'Time spent waiting for the encoding window.')
+retries = Counter('video_encode_retries', 'Encode retries by phase.', 'phase')
+
+registry = [queue_files, queue_bytes, converted, failed, bytes_saved, encode_fps, encode_speed, probe_seconds,
+            scan_seconds, window_wait_seconds, retries]
+
+
+def exposition():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.exposition())
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, address='127.0.0.1'):
+    """
+    Serve /metrics on a background thread.
+    :return: The server, so the caller can shut it down.
+    """
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
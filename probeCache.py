@@ -0,0 +1,170 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import os
+import sqlite3
+import threading
+
+from pathlib import Path
+
+import mediaProbe
+
+
+class ProbeCache:
+    """
+    On-disk cache of ffprobe results. Entries are keyed by path and are only returned while the
+    file's size, mtime and inode still match what was probed, so a changed file is re-probed.
+
+    It also remembers sources whose encode was abandoned because it would not have saved enough,
+    by path, size and mtime, so they are not tried again until they change, and the CRF a sample
+    search chose for each source.
+    """
+
+    cache_file = None
+    connection = None
+    lock = None
+    unprofitable = {}
+
+    def __init__(self, cache_file=None):
+        if cache_file is None:
+            database = ':memory:'
+        else:
+            self.cache_file = Path(cache_file).expanduser()
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            database = self.cache_file.as_posix()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS probes (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    data TEXT NOT NULL
+                )''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS unprofitable (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    projected_size INTEGER NOT NULL
+                )''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS crf_choices (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    settings TEXT NOT NULL,
+                    crf INTEGER NOT NULL
+                )''')
+            self.unprofitable = {path: (size, mtime) for path, size, mtime in
+                                 self.connection.execute('SELECT path, size, mtime FROM unprofitable')}
+
+    def lookup(self, path, stat_result=None):
+        """
+        :return: The cached MediaInfo for path, or None if there is no entry or the file has changed.
+        """
+        path = os.path.abspath(path)
+        if stat_result is None:
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                return None
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT size, mtime_ns, inode, data FROM probes WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, inode, data = row
+        if (size, mtime_ns, inode) != (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino):
+            self.forget(path)
+            return None
+        return mediaProbe.MediaInfo.from_json(data)
+
+    def store(self, path, media_info, stat_result=None):
+        path = os.path.abspath(path)
+        if stat_result is None:
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                return
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO probes (path, size, mtime_ns, inode, data) VALUES (?, ?, ?, ?, ?)',
+                (path, stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, media_info.to_json()))
+
+    def probe(self, path, stat_result=None):
+        """
+        Return the cached probe for path, running ffprobe only when there is no valid entry.
+        Failed probes are not cached so a transient read error doesn't stick.
+        """
+        if stat_result is None:
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                return None
+        media_info = self.lookup(path, stat_result)
+        if media_info is not None:
+            return media_info
+        media_info = mediaProbe.probe_media(Path(path))
+        if media_info is not None:
+            self.store(path, media_info, stat_result)
+        return media_info
+
+    def mark_unprofitable(self, path, size, mtime, projected_size):
+        """
+        Remember that converting path, at this size and mtime, is not worth it.
+        """
+        path = os.path.abspath(path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO unprofitable (path, size, mtime, projected_size) VALUES (?, ?, ?, ?)',
+                (path, size, mtime, projected_size))
+            self.unprofitable[path] = (size, mtime)
+
+    def is_unprofitable(self, path, size, mtime):
+        """
+        :return: True if path was marked unprofitable and hasn't changed since.
+        """
+        with self.lock:
+            return self.unprofitable.get(os.path.abspath(path)) == (size, mtime)
+
+    def lookup_crf(self, path, size, mtime, settings):
+        """
+        :return: The CRF chosen for path by a search with the same settings, or None.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime, settings, crf FROM crf_choices WHERE path = ?',
+                                          (os.path.abspath(path),)).fetchone()
+        if row is None or tuple(row[:3]) != (size, mtime, settings):
+            return None
+        return row[3]
+
+    def store_crf(self, path, size, mtime, settings, crf):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO crf_choices (path, size, mtime, settings, crf) VALUES (?, ?, ?, ?, ?)',
+                (os.path.abspath(path), size, mtime, settings, crf))
+
+    def forget(self, path):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM probes WHERE path = ?', (os.path.abspath(path),))
+
+    def prune(self, root, seen_paths):
+        """
+        Evict entries under root that were not seen by the latest scan of root.
+        :return: The number of entries evicted.
+        """
+        prefix = os.path.join(os.path.abspath(root), '')
+        seen_paths = {os.path.abspath(path) for path in seen_paths}
+        with self.lock:
+            paths = [row[0] for row in self.connection.execute('SELECT path FROM probes')]
+        stale = [(path,) for path in paths if path.startswith(prefix) and path not in seen_paths]
+        if len(stale) > 0:
+            with self.lock, self.connection:
+                self.connection.executemany('DELETE FROM probes WHERE path = ?', stale)
+        return len(stale)
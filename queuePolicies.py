@@ -0,0 +1,72 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+
+class QueuePolicy:
+    """
+    Decides the order file_queue is drained in. Lower priorities go first.
+    Policies that need an Estimate set needs_probe; policies whose order depends on the time left
+    in the encoding window set dynamic, and the queue is re-sorted before each job is taken.
+    """
+
+    name = None
+    needs_probe = False
+    dynamic = False
+
+    def priority(self, size, mtime, estimate, remaining=None):
+        raise NotImplementedError
+
+
+class SmallestFirstPolicy(QueuePolicy):
+
+    name = 'smallest'
+
+    def priority(self, size, mtime, estimate, remaining=None):
+        return size
+
+
+class LargestSavingsPolicy(QueuePolicy):
+    """
+    Most bytes saved per second of encoding first.
+    """
+
+    name = 'savings'
+    needs_probe = True
+
+    def priority(self, size, mtime, estimate, remaining=None):
+        return -estimate.savings_rate()
+
+
+class OldestFirstPolicy(QueuePolicy):
+
+    name = 'oldest'
+
+    def priority(self, size, mtime, estimate, remaining=None):
+        return mtime
+
+
+class DeadlinePolicy(QueuePolicy):
+    """
+    Jobs that fit in what is left of the encoding window first, best savings rate first among
+    them; jobs that won't fit go after, shortest first.
+    """
+
+    name = 'deadline'
+    needs_probe = True
+    dynamic = True
+
+    def priority(self, size, mtime, estimate, remaining=None):
+        if remaining is None or estimate.encode_seconds <= remaining:
+            return (0, -estimate.savings_rate())
+        return (1, estimate.encode_seconds)
+
+
+policies = {policy.name: policy for policy in [SmallestFirstPolicy, LargestSavingsPolicy, OldestFirstPolicy,
+                                               DeadlinePolicy]}
+
+
+def create_policy(name):
+    return policies[name]()
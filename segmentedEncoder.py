@@ -0,0 +1,348 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import math
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+from pathlib import Path
+
+import encodeController
+import encodeProgress
+import encodeScheduler
+
+
+class SegmentedEncoder:
+    """
+    Encodes one large source as several keyframe-aligned segments in parallel, then concatenates
+    them losslessly. Audio is encoded once for the whole file. Segments are written under a
+    work directory named after the source, and a segment that finished is never encoded again.
+
+    The work directory holds a journal with the segment plan and the segments that are done, so
+    an encode that was interrupted, or whose process died, picks up with only the missing segments.
+    """
+
+    converter = None
+    segments = 1
+    min_size = 0
+    min_duration = 0
+    # When set, every source longer than this is cut into pieces of about this many seconds,
+    # encoded self.segments at a time, so an interrupted encode loses at most one piece per worker.
+    segment_duration = None
+
+    def __init__(self, converter, segments=1, min_size=20 * 1024 * 1024 * 1024, min_duration=2 * 60 * 60):
+        self.converter = converter
+        self.segments = segments
+        self.min_size = min_size
+        self.min_duration = min_duration
+
+    def should_segment(self, src_size, media_info):
+        if media_info is None or not media_info.has_video or not media_info.duration:
+            return False
+        if self.segment_duration is not None and media_info.duration > self.segment_duration:
+            return True
+        if self.segments <= 1:
+            return False
+        return src_size >= self.min_size or media_info.duration >= self.min_duration
+
+    def segment_count(self, media_info):
+        if self.segment_duration is None:
+            return self.segments
+        return max(self.segments, math.ceil(media_info.duration / self.segment_duration))
+
+    def work_dir(self, src_file, tmp_path):
+        stat_result = src_file.stat()
+        key = f'{src_file.resolve()}:{stat_result.st_size}:{stat_result.st_mtime_ns}'
+        digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+        base_name = src_file.stem.replace(" ", "")
+        return tmp_path.joinpath(f'.{base_name}.segments-{digest}')
+
+    def find_keyframe(self, src_file, position, start_time=0.0):
+        """
+        Positions are relative to start_time, the source's first timestamp, as -ss is; ffprobe's
+        packet times and -read_intervals are not, so start_time is added and taken away again.
+        :return: The time of the first video keyframe at or after position, or None if there isn't one
+                 within a minute.
+        """
+        command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                   '-read_intervals', f'{start_time + position}%+60',
+                   '-show_entries', 'packet=pts_time,flags',
+                   '-of', 'csv=p=0', str(src_file)]
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        for line in result.stdout.splitlines():
+            fields = line.strip().split(',')
+            if len(fields) < 2 or 'K' not in fields[1]:
+                continue
+            try:
+                pts_time = float(fields[0]) - start_time
+            except ValueError:
+                continue
+            if pts_time >= position:
+                return pts_time
+        return None
+
+    def plan_segments(self, src_file, media_info, count):
+        """
+        Split the source into count roughly equal pieces whose boundaries fall on keyframes.
+        :return: A list of (start, duration) pairs; the last duration is None, meaning to the end.
+        """
+        step = media_info.duration / count
+        boundaries = [0.0]
+        for index in range(1, count):
+            keyframe = self.find_keyframe(src_file, step * index, media_info.start_time)
+            if keyframe is not None and keyframe > boundaries[-1] and keyframe < media_info.duration:
+                boundaries.append(keyframe)
+        plan = []
+        for index, start in enumerate(boundaries):
+            if index + 1 < len(boundaries):
+                plan.append((start, boundaries[index + 1] - start))
+            else:
+                plan.append((start, None))
+        return plan
+
+    def split_slot(self, slot, count):
+        """
+        Divide a scheduler slot between count concurrent segment encodes.
+        """
+        if slot is None:
+            return [None] * count
+        cpus = slot.cpus
+        size = max(1, len(cpus) // count)
+        slots = []
+        for index in range(count):
+            chunk = cpus[(index * size) % len(cpus):][:size]
+            slots.append(encodeScheduler.EncodeSlot(len(chunk), chunk, slot.pin))
+        return slots
+
+    def segment_file(self, work_dir, index):
+        return work_dir.joinpath(f'segment-{index:04d}.mkv')
+
+    def encode_segment(self, src_file, work_dir, index, start, duration, media_info, slot, guard=None):
+        segment_file = self.segment_file(work_dir, index)
+        if segment_file.exists() and segment_file.stat().st_size > 0:
+            self.converter.log(f'{datetime.datetime.now()}: Segment {index} already encoded.')
+            return subprocess.CompletedProcess([], 0), None
+        partial_file = work_dir.joinpath(f'segment-{index:04d}.partial.mkv')
+        partial_file.unlink(missing_ok=True)
+        command = ['ffmpeg', '-y', '-report']
+        command.extend(self.converter.build_input_options(src_file))
+        command.extend(['-ss', f'{start:.6f}', '-i', src_file])
+        if duration is not None:
+            command.extend(['-t', f'{duration:.6f}'])
+        command.extend(['-map', '0:v:0', '-an', '-sn', '-dn'])
+        command.extend(self.converter.build_video_options(media_info, slot,
+                                                          self.converter.profile_for(src_file, media_info)))
+        command.extend(['-f', 'matroska', partial_file])
+        if duration is None and media_info.duration is not None:
+            duration = media_info.duration - start
+        output, log_file = self.converter.run_ffmpeg(command, work_dir, f'segment-{index:04d}', slot, duration,
+                                                     guard)
+        if output.returncode == 0 and partial_file.exists() and partial_file.stat().st_size > 0:
+            partial_file.rename(segment_file)
+        else:
+            partial_file.unlink(missing_ok=True)
+        return output, log_file
+
+    def encode_audio(self, src_file, work_dir, media_info):
+        audio_file = work_dir.joinpath('audio.mka')
+        if audio_file.exists() and audio_file.stat().st_size > 0:
+            return subprocess.CompletedProcess([], 0), None, audio_file
+        partial_file = work_dir.joinpath('audio.partial.mka')
+        command = ['ffmpeg', '-y', '-report']
+        command.extend(self.converter.build_input_options(src_file))
+        command.extend(['-i', src_file, '-vn', '-sn', '-dn', '-map', '0:a:0'])
+        command.extend(self.converter.build_audio_options(media_info))
+        command.extend(['-f', 'matroska', partial_file])
+        output, log_file = self.converter.run_ffmpeg(command, work_dir, 'segment-audio')
+        if output.returncode == 0 and partial_file.exists():
+            partial_file.rename(audio_file)
+        else:
+            partial_file.unlink(missing_ok=True)
+        return output, log_file, audio_file
+
+    def concatenate(self, work_dir, count, audio_file, tmp_file):
+        list_file = work_dir.joinpath('segments.txt')
+        with list_file.open('w') as segment_list:
+            for index in range(count):
+                segment_list.write(f"file '{self.segment_file(work_dir, index).name}'\n")
+        command = ['ffmpeg', '-y', '-report', '-f', 'concat', '-safe', '0', '-i', list_file]
+        if audio_file is not None:
+            command.extend(['-i', audio_file, '-map', '0:v:0', '-map', '1:a:0'])
+        else:
+            command.extend(['-map', '0:v:0'])
+        command.extend(['-c', 'copy', '-avoid_negative_ts', 'make_zero', '-tag:v', 'hvc1', tmp_file])
+        return self.converter.run_ffmpeg(command, work_dir, 'segment-concat')
+
+    def source_identity(self, src_file):
+        stat_result = src_file.stat()
+        return {
+            'source': str(src_file.resolve()),
+            'size': stat_result.st_size,
+            'mtime_ns': stat_result.st_mtime_ns
+        }
+
+    def journal_file(self, work_dir):
+        return work_dir.joinpath('journal.json')
+
+    def read_journal(self, work_dir):
+        try:
+            return json.loads(self.journal_file(work_dir).read_text())
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def write_journal(self, work_dir, journal):
+        journal_file = self.journal_file(work_dir)
+        partial_file = journal_file.with_suffix('.partial')
+        partial_file.write_text(json.dumps(journal, indent=2))
+        os.replace(partial_file, journal_file)
+
+    def load_plan(self, src_file, work_dir, media_info, dest_file, input_file=None):
+        """
+        Reuse the plan from an existing journal for this exact source, or make a new one. Segment files
+        the journal doesn't list as complete are removed, since they may be from a run that died.
+        :return: The journal.
+        """
+        identity = self.source_identity(src_file)
+        journal = self.read_journal(work_dir)
+        if journal is not None and all(journal.get(key) == value for key, value in identity.items()):
+            completed = [index for index in journal.get('completed', [])
+                         if self.segment_file(work_dir, index).exists()]
+            journal['completed'] = completed
+            for segment_file in work_dir.glob('segment-*.mkv'):
+                index = int(segment_file.name.split('-')[1].split('.')[0])
+                if index not in completed:
+                    segment_file.unlink(missing_ok=True)
+            self.converter.log(f'{datetime.datetime.now()}: Resuming {src_file}; {len(completed)} of '
+                               f'{len(journal["plan"])} segments already encoded.')
+        else:
+            for stale_file in work_dir.iterdir():
+                if stale_file.is_file():
+                    stale_file.unlink()
+            journal = dict(identity)
+            journal['plan'] = self.plan_segments(input_file or src_file, media_info, self.segment_count(media_info))
+            journal['completed'] = []
+        if dest_file is not None:
+            journal['destination'] = str(dest_file)
+        self.write_journal(work_dir, journal)
+        return journal
+
+    def mark_complete(self, work_dir, journal, index, journal_lock):
+        with journal_lock:
+            if index not in journal['completed']:
+                journal['completed'].append(index)
+                journal['completed'].sort()
+                self.write_journal(work_dir, journal)
+
+    def find_journals(self, tmp_path):
+        """
+        Look for interrupted encodes under tmp_path. Work directories whose source is gone or has
+        changed since are removed.
+        :return: A list of journals for encodes that can be resumed.
+        """
+        journals = []
+        if tmp_path is None or not tmp_path.exists():
+            return journals
+        for work_dir in tmp_path.glob('.*.segments-*'):
+            journal = self.read_journal(work_dir)
+            if journal is None:
+                continue
+            src_file = Path(journal.get('source', ''))
+            try:
+                current = self.source_identity(src_file)
+            except OSError:
+                current = None
+            if current is None or any(journal.get(key) != value for key, value in current.items()):
+                shutil.rmtree(work_dir, ignore_errors=True)
+                continue
+            journals.append(journal)
+        return journals
+
+    def encode(self, src_file, tmp_file, tmp_path, media_info, slot=None, dest_file=None, guard=None,
+               input_file=None):
+        """
+        Encode src_file to tmp_file in segments.
+        :param input_file: If given, what ffmpeg reads instead of src_file, such as a staged copy. The work
+                           directory and journal still belong to src_file.
+        :return: (output, log_file) like run_ffmpeg; the work directory is removed on success.
+        """
+        if input_file is None:
+            input_file = src_file
+        work_dir = self.work_dir(src_file, tmp_path)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        journal = self.load_plan(src_file, work_dir, media_info, dest_file, input_file)
+        journal_lock = threading.Lock()
+        plan = journal['plan']
+        parallel = max(1, min(self.segments, len(plan)))
+        self.converter.log(f'{datetime.datetime.now()}: Encoding {src_file} as {len(plan)} segments in {work_dir}...')
+
+        output, log_file = subprocess.CompletedProcess([], 0), None
+        audio_file = None
+        if media_info.has_audio:
+            output, log_file, audio_file = self.encode_audio(input_file, work_dir, media_info)
+            if output.returncode != 0:
+                return output, log_file
+
+        slots = queue.Queue()
+        for segment_slot in self.split_slot(slot, parallel):
+            slots.put(segment_slot)
+        label = self.converter.job_label()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = []
+            for index, (start, duration) in enumerate(plan):
+                if index in journal['completed']:
+                    continue
+                futures.append(executor.submit(self.run_segment, label, input_file, work_dir, index, start,
+                                               duration, media_info, slots, journal, journal_lock, guard))
+            results = []
+            interrupted = None
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except (encodeController.EncodeInterrupted, encodeProgress.EncodeAbandoned) as e:
+                    # Segments already running will be stopped too; don't start any more.
+                    interrupted = e
+                    for pending in futures:
+                        pending.cancel()
+                except concurrent.futures.CancelledError:
+                    pass
+        if interrupted is not None:
+            raise interrupted
+        for output, log_file in results:
+            if output.returncode != 0:
+                return output, log_file
+
+        output, log_file = self.concatenate(work_dir, len(plan), audio_file, tmp_file)
+        if output.returncode == 0:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return output, log_file
+
+    def run_segment(self, label, src_file, work_dir, index, start, duration, media_info, slots, journal,
+                    journal_lock, guard=None):
+        if label is not None:
+            self.converter.set_job_label(f'{label} segment {index}')
+        else:
+            self.converter.set_job_label(f'segment {index}')
+        slot = slots.get()
+        try:
+            output, log_file = self.encode_segment(src_file, work_dir, index, start, duration, media_info, slot,
+                                                   guard)
+        finally:
+            slots.put(slot)
+        if output.returncode == 0:
+            self.mark_complete(work_dir, journal, index, journal_lock)
+        return output, log_file
+
+    def discard(self, src_file, tmp_path):
+        shutil.rmtree(self.work_dir(src_file, tmp_path), ignore_errors=True)
@@ -0,0 +1,170 @@
+"""
+
+Copyright © 2026 Syd Polk
+
+"""
+
+import datetime
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+
+from pathlib import Path
+
+
+class StagedCopy:
+
+    source = None
+    path = None
+    size = 0
+    mtime = None
+    ready = None
+    failed = False
+    taken = False
+
+    def __init__(self, source, path, size, mtime):
+        self.source = source
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.ready = threading.Event()
+
+
+class StagingPrefetcher:
+    """
+    Copies the next few files in the queue to local scratch space while the current encodes run,
+    so the encoder reads from local disk instead of over the network. At most ahead files are
+    staged at once, and together they never take more than budget bytes. A file too big for the
+    budget is read where it is.
+    """
+
+    traverser = None
+    stage_dir = None
+    budget = 0
+    ahead = 2
+    interval = 5
+    staged = {}
+    lock = None
+    thread = None
+    stopping = False
+
+    def __init__(self, traverser, stage_dir, budget, ahead=2):
+        self.traverser = traverser
+        self.stage_dir = Path(stage_dir).expanduser()
+        self.stage_dir.mkdir(parents=True, exist_ok=True)
+        self.budget = budget
+        self.ahead = ahead
+        self.staged = {}
+        self.lock = threading.Lock()
+        self.clean()
+
+    def clean(self):
+        """
+        Remove copies left behind by an earlier run. Interrupted encodes are journaled under their
+        library file, not the copy, so none of these is needed to resume one.
+        """
+        for path in self.stage_dir.glob('*.staged-*'):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True, name='prefetcher')
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def used(self):
+        with self.lock:
+            return sum(copy.size for copy in self.staged.values())
+
+    def upcoming(self):
+        """
+        The next files the queue will hand out, in order.
+        """
+        file_queue = self.traverser.file_queue
+        with file_queue.mutex:
+            entries = sorted(file_queue.queue)[:self.ahead]
+        return [(video, size, mtime) for _, size, video, _, mtime in entries]
+
+    def evict(self, upcoming):
+        """
+        Drop copies that are ready but no longer near the front of the queue.
+        """
+        with self.lock:
+            stale = [video for video, copy in self.staged.items()
+                     if not copy.taken and copy.ready.is_set() and video not in upcoming]
+        for video in stale:
+            self.release(video)
+
+    def run(self):
+        while not self.stopping and not self.traverser.stop_requested:
+            staged_one = False
+            upcoming = self.upcoming()
+            self.evict({video for video, _, _ in upcoming})
+            for video, size, mtime in upcoming:
+                with self.lock:
+                    waiting = [copy for copy in self.staged.values() if not copy.taken]
+                    if video in self.staged or len(waiting) >= self.ahead:
+                        continue
+                if self.used() + size > self.budget:
+                    continue
+                self.stage(video, size, mtime)
+                staged_one = True
+                break
+            if not staged_one:
+                time.sleep(self.interval)
+
+    def staged_path(self, video):
+        key = hashlib.sha1(os.path.abspath(video).encode()).hexdigest()[:12]
+        return self.stage_dir.joinpath(f'{Path(video).stem}.staged-{key}', Path(video).name)
+
+    def stage(self, video, size, mtime):
+        path = self.staged_path(video)
+        copy = StagedCopy(video, path, size, mtime)
+        with self.lock:
+            self.staged[video] = copy
+        print(f'{datetime.datetime.now()}: Staging {video} to {path}...')
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(video, path)
+            if os.stat(path).st_size != size:
+                raise OSError(f'{video} changed while it was being staged')
+        except OSError as e:
+            print(f'{datetime.datetime.now()}: Could not stage {video}: {e}', file=sys.stderr)
+            copy.failed = True
+            shutil.rmtree(path.parent, ignore_errors=True)
+        copy.ready.set()
+
+    def take(self, video, size, mtime):
+        """
+        Called when video is about to be converted. Waits for a copy that is still being made.
+        :return: The path of the local copy, or None if there isn't a good one.
+        """
+        with self.lock:
+            copy = self.staged.get(video)
+        if copy is None:
+            return None
+        copy.taken = True
+        copy.ready.wait()
+        if copy.failed or (copy.size, copy.mtime) != (size, mtime):
+            self.release(video)
+            return None
+        return copy.path
+
+    def release(self, video):
+        """
+        Delete the local copy of video, if there is one.
+        """
+        with self.lock:
+            copy = self.staged.pop(video, None)
+        if copy is not None:
+            shutil.rmtree(copy.path.parent, ignore_errors=True)